@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+
+class TTLCache(object):
+    '''
+    A thread-safe mapping whose entries expire `ttl` seconds after they
+    have been set. If `sliding` is True, reading an entry renews it as
+    well, so only idle entries expire. `on_expire` is called with the
+    value of every entry that expires.
+    '''
+
+    def __init__(self, ttl, sliding=False, on_expire=None):
+        self.ttl = ttl
+        self.sliding = sliding
+        self.on_expire = on_expire
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                return default
+            if self.sliding:
+                self._entries[key] = (value, now)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            self._entries[key] = (value, now)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._entries.pop(key)
+            except KeyError:
+                return default
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._entries)
+
+    def _expire(self, now):
+        expired = [
+            key for key, (_, stamp) in self._entries.iteritems()
+            if now - stamp > self.ttl
+        ]
+        for key in expired:
+            value, _ = self._entries.pop(key)
+            if self.on_expire is not None:
+                self.on_expire(value)
+
+
+class LRUCache(object):
+    '''
+    A thread-safe mapping of at most `maxsize` entries. Once it is full,
+    setting an entry drops the entry which has not been read or set for
+    the longest time.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def memoize(func, maxsize):
+    '''
+    Return a function which remembers the results of `func`, a function
+    of a single hashable argument, for the last `maxsize` arguments.
+    '''
+    cache = LRUCache(maxsize)
+    missing = object()
+
+    @wraps(func)
+    def memoized(arg):
+        result = cache.get(arg, missing)
+        if result is missing:
+            result = func(arg)
+            cache.set(arg, result)
+        return result
+
+    memoized.cache = cache
+    return memoized
@@ -0,0 +1,134 @@
+'''
+What a repository offers and how fast it answers. The capabilities are
+probed with Identify, ListMetadataFormats and ListSets once in a while
+instead of in every job, and the size and duration of the list pages are
+measured while the repository is listed. With them, the harvester can
+choose how to harvest a repository.
+'''
+import json
+from itertools import islice
+
+from oaipmh import error
+from oaipmh.datestamp import datestamp_to_datetime
+from oaipmh.datestamp import datetime_to_datestamp
+
+# at most this many sets are kept
+MAX_SETS = 1000
+# weight of a new measurement in the averages of the list pages
+SMOOTHING = 0.2
+# full listings which are expected to take longer are partitioned
+PARTITION_SECONDS = 600
+
+
+class Capabilities(object):
+    '''
+    The capabilities of a repository. `pages` holds the average number of
+    items and seconds of a list page per verb, `records` the number of
+    records of the last full listing.
+    '''
+
+    def __init__(self, granularity=None, deleted_record=None,
+                 compression=(), earliest_datestamp=None,
+                 metadata_prefixes=(), sets=(), pages=None, records=None):
+        self.granularity = granularity
+        self.deleted_record = deleted_record
+        self.compression = list(compression)
+        self.earliest_datestamp = earliest_datestamp
+        self.metadata_prefixes = list(metadata_prefixes)
+        self.sets = list(sets)
+        self.pages = pages or {}
+        self.records = records
+
+    @classmethod
+    def probe(cls, client):
+        '''
+        Ask the repository of the client what it offers. The measurements
+        of the list pages are left empty.
+        '''
+        identify = client.identify()
+        try:
+            sets = [spec for spec, _, _ in islice(client.listSets(), MAX_SETS)]
+        except error.NoSetHierarchyError:
+            sets = []
+        return cls(
+            granularity=identify.granularity(),
+            deleted_record=identify.deletedRecord(),
+            compression=identify.compression(),
+            earliest_datestamp=identify.earliestDatestamp(),
+            metadata_prefixes=[
+                prefix for prefix, _, _ in client.listMetadataFormats()
+            ],
+            sets=sets,
+        )
+
+    @property
+    def day_granularity(self):
+        return self.granularity == 'YYYY-MM-DD'
+
+    def observe_page(self, verb, items, seconds):
+        '''
+        Add a list page of `items` items which took `seconds` to request
+        and read to the averages of the verb.
+        '''
+        page = self.pages.get(verb)
+        if page is None:
+            self.pages[verb] = {'items': items, 'seconds': seconds}
+            return
+        for key, value in (('items', items), ('seconds', seconds)):
+            page[key] += SMOOTHING * (value - page[key])
+
+    def listing_seconds(self, verb):
+        '''
+        Return the expected duration of a full listing with the verb, or
+        None if it is not known yet. The pages of ListIdentifiers stand
+        in for the ones of ListRecords if there are no others.
+        '''
+        page = self.pages.get(verb) or self.pages.get('ListIdentifiers')
+        if page is None or self.records is None or page['items'] < 1:
+            return None
+        return float(self.records) / page['items'] * page['seconds']
+
+    def strategy(self, metadata_prefix, full=True):
+        '''
+        Return the cheapest way to harvest the records in the metadata
+        format: whether to list the records instead of getting each record
+        on its own, and how to partition the listing. Only full listings
+        are partitioned, and only by dates, as a listing partitioned by
+        sets leaves out the records which are in no set. Raises ValueError
+        if the repository does not offer the format.
+        '''
+        if self.metadata_prefixes and \
+                metadata_prefix not in self.metadata_prefixes:
+            raise ValueError(
+                'The repository offers no %s records, only %s'
+                % (metadata_prefix, ', '.join(self.metadata_prefixes))
+            )
+        partition = None
+        seconds = self.listing_seconds('ListRecords')
+        if full and seconds is not None and seconds > PARTITION_SECONDS \
+                and self.earliest_datestamp is not None:
+            partition = 'dates'
+        return {'list_records': True, 'partition': partition}
+
+    def dump(self):
+        '''
+        Serialize the capabilities as JSON.
+        '''
+        data = dict(self.__dict__)
+        if self.earliest_datestamp is not None:
+            data['earliest_datestamp'] = datetime_to_datestamp(
+                self.earliest_datestamp
+            )
+        return json.dumps(data)
+
+    @classmethod
+    def load(cls, data):
+        '''
+        Return the capabilities serialized with dump.
+        '''
+        data = json.loads(data)
+        if data.get('earliest_datestamp') is not None:
+            data['earliest_datestamp'] = datestamp_to_datetime(
+                data['earliest_datestamp']
+            )
+        return cls(**data)
@@ -0,0 +1,227 @@
+'''
+An OAI-PMH client which reuses its HTTP connections, and a pool to share
+these clients between the harvest objects of a source.
+'''
+import logging
+import threading
+import time
+import urllib2
+from StringIO import StringIO
+from urllib import urlencode
+
+import requests
+import oaipmh.client
+
+from cache import TTLCache
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# close the connections of a client once it has not been used for 5 minutes
+MAX_IDLE = 300
+
+# seconds to wait for the connection to a repository and for each read of
+# a response, a repository which stops answering fails the request
+REQUEST_TIMEOUT = 60
+
+# bounds of the interval between two requests after 503 responses
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+
+class Throttle(object):
+    '''
+    Spaces the requests to a repository, which may be sent from several
+    threads: at most `rate` requests per second if a rate is given, and
+    none before the Retry-After of a 503 response has passed. Every 503
+    response also doubles the interval between requests, every successful
+    request halves it again until the rate limit applies alone.
+    '''
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._backoff = 0.0
+        self._not_before = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._not_before)
+            self._not_before = start + self._interval()
+        if start > now:
+            time.sleep(start - now)
+
+    def busy(self, retry_after):
+        with self._lock:
+            self._backoff = min(
+                max(self._backoff * 2, MIN_BACKOFF),
+                MAX_BACKOFF
+            )
+            self._not_before = max(
+                self._not_before,
+                time.time() + retry_after
+            )
+
+    def success(self):
+        with self._lock:
+            if self._backoff > MIN_BACKOFF:
+                self._backoff /= 2
+            else:
+                self._backoff = 0.0
+
+    def _interval(self):
+        interval = 1.0 / self.rate if self.rate else 0.0
+        return max(interval, self._backoff)
+
+
+class OaipmhClient(oaipmh.client.Client):
+    '''
+    pyoai client which sends its requests through a requests session, so
+    that the TCP connection and TLS session to a repository are kept alive
+    between requests.
+
+    HTTP errors are raised as urllib2.HTTPError, like pyoai does. The
+    requests are spaced by the throttle of the client. The responses are
+    parsed with `parser` if one is given, e.g. a
+    ckanext.oaipmh.metadata.PruningParser. A request which gets no answer
+    within `timeout` seconds raises requests.exceptions.Timeout.
+    '''
+
+    def __init__(self, base_url, metadata_registry=None, credentials=None,
+                 force_http_get=False, parser=None, timeout=REQUEST_TIMEOUT):
+        oaipmh.client.Client.__init__(
+            self,
+            base_url,
+            metadata_registry,
+            credentials,
+            force_http_get=force_http_get
+        )
+        self.throttle = Throttle()
+        self._parser = parser
+        self._timeout = timeout
+        # responses handed to handleResponse, per thread
+        self._responses = threading.local()
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = 'pyoai'
+        # OAI-PMH responses compress very well, requests decodes them
+        self._session.headers['Accept-Encoding'] = 'gzip, deflate'
+        if credentials is not None:
+            self._session.auth = credentials
+
+    def makeRequest(self, **kw):
+        xml = getattr(self._responses, 'xml', None)
+        if xml is not None:
+            return xml
+        verb = kw.get('verb')
+        for _ in range(oaipmh.client.WAIT_MAX):
+            self.throttle.wait()
+            with metrics.timer('request', verb=verb):
+                response = self._send(kw)
+            metrics.count('response_bytes', len(response.content), verb=verb)
+            metrics.count(
+                'transferred_bytes', _transferred_bytes(response), verb=verb
+            )
+            metrics.count('responses', verb=verb, status=response.status_code)
+            if response.status_code != 503:
+                self.throttle.success()
+                break
+            wait = _retry_after(response, oaipmh.client.WAIT_DEFAULT)
+            log.info('%s is busy, retry in %ss' % (self._base_url, wait))
+            self.throttle.busy(wait)
+        else:
+            raise oaipmh.client.Error(
+                'Waited too often (more than %s times)'
+                % oaipmh.client.WAIT_MAX
+            )
+        if response.status_code >= 400:
+            raise urllib2.HTTPError(
+                response.url,
+                response.status_code,
+                response.reason,
+                response.headers,
+                StringIO(response.content)
+            )
+        return response.content
+
+    def handleResponse(self, verb, xml, **kw):
+        '''
+        Return what the verb returns for a response which has been
+        received with makeRequest(verb=verb, **kw) before, so that the
+        requests and the parsing of the responses can run in different
+        threads. Errors reported by the repository are raised.
+        '''
+        self._responses.xml = xml
+        try:
+            return self.handleVerb(verb, dict(kw))
+        finally:
+            self._responses.xml = None
+
+    def parse(self, xml):
+        with metrics.timer('parse'):
+            if self._parser is None or self._ignore_bad_character_hack:
+                return oaipmh.client.Client.parse(self, xml)
+            return self._parser(xml)
+
+    def _send(self, kw):
+        if self._force_http_get:
+            return self._session.get(
+                '%s?%s' % (self._base_url, urlencode(kw)),
+                timeout=self._timeout
+            )
+        return self._session.post(
+            self._base_url, data=kw, timeout=self._timeout
+        )
+
+    def close(self):
+        self._session.close()
+
+
+def _transferred_bytes(response):
+    '''
+    Return the size of the body of the response as it has been received,
+    before it has been decompressed.
+    '''
+    try:
+        return response.raw.tell()
+    except Exception:
+        return len(response.content)
+
+
+def _retry_after(response, default):
+    try:
+        return int(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return default
+
+
+class ClientPool(object):
+    '''
+    Process-wide OAI-PMH clients keyed by repository URL, credentials,
+    request method, parser of the responses and request timeout. Clients
+    which have been idle for `max_idle` seconds are closed.
+    '''
+
+    def __init__(self, max_idle=MAX_IDLE):
+        self._clients = TTLCache(
+            max_idle,
+            sliding=True,
+            on_expire=lambda client: client.close()
+        )
+
+    def get(self, url, metadata_registry, credentials=None,
+            force_http_get=False, parser=None, timeout=REQUEST_TIMEOUT):
+        key = (url, credentials, force_http_get, parser, timeout)
+        client = self._clients.get(key)
+        if client is None:
+            log.debug('Create OAI-PMH client for %s' % url)
+            client = OaipmhClient(
+                url,
+                metadata_registry,
+                credentials,
+                force_http_get=force_http_get,
+                parser=parser,
+                timeout=timeout
+            )
+            self._clients.set(key, client)
+        return client
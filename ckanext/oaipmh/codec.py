@@ -0,0 +1,34 @@
+'''
+Compact storage of the content of harvest objects. The content column of
+harvest objects holds text, so compressed content is stored base64
+encoded behind a tag with the version of the encoding. Content without a
+tag is the plain JSON the harvester has always stored.
+'''
+import base64
+import zlib
+
+# JSON objects start with '{', so the tag can not be mistaken for content
+ZLIB_TAG = u'z1:'
+
+
+def encode_content(content, compress=False):
+    '''
+    Return the JSON content as stored in a harvest object, compressed if
+    `compress` is set.
+    '''
+    if not compress:
+        return content
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return ZLIB_TAG + base64.b64encode(zlib.compress(content)).decode('ascii')
+
+
+def decode_content(content):
+    '''
+    Return the JSON content of a harvest object, however it has been
+    stored.
+    '''
+    if content is None or not content.startswith(ZLIB_TAG):
+        return content
+    data = base64.b64decode(content[len(ZLIB_TAG):])
+    return zlib.decompress(data).decode('utf-8')
@@ -0,0 +1,245 @@
+'''
+Paster commands of the OAI-PMH harvester.
+'''
+import logging
+import sys
+
+from ckan.lib.cli import CkanCommand
+
+from harvester import OaipmhHarvester
+from listing import list_pages
+from recording import ArchivingClient
+from recording import ResponseArchive
+
+log = logging.getLogger(__name__)
+
+
+class OaipmhCommand(CkanCommand):
+    '''OAI-PMH harvester commands
+
+    Usage:
+
+      oaipmh profile {source-id|source-name} [--records=N]
+                     [--record=DIR | --replay=DIR] [--output=FILE]
+        - harvest the first N records (default 100) of the source in this
+          process and report the functions which take the most time and
+          the memory allocated in the gather, fetch and import stage and
+          in the metadata readers. The records are imported into this CKAN
+          instance like by any other job. With --record, the responses of
+          the repository are saved in DIR, with --replay they are read
+          from DIR instead of asking the repository.
+
+      oaipmh requeue
+        - publish a gather message for every job with a distributed
+          listing whose partitions have not been claimed or have not saved
+          a batch for `partition_lease` seconds, e.g. because the consumer
+          gathering them has been killed. The consumer of the message
+          claims them again. Run it from cron next to `harvester run`.
+
+    The commands should be run from the ckanext-oaipmh directory and
+    expect a development.ini file to be present. Most of the time you will
+    specify the config explicitly though:
+
+        paster oaipmh profile my-source --config=../ckan/development.ini
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def __init__(self, name):
+        CkanCommand.__init__(self, name)
+        self.parser.add_option(
+            '-n', '--records', dest='records', type='int', default=100,
+            help='number of records to harvest'
+        )
+        self.parser.add_option(
+            '--record', dest='record', default=None,
+            help='save the responses of the repository in this directory'
+        )
+        self.parser.add_option(
+            '--replay', dest='replay', default=None,
+            help='read the responses of the repository from this directory'
+        )
+        self.parser.add_option(
+            '-o', '--output', dest='output', default=None,
+            help='file to write the report to, defaults to stdout'
+        )
+        self.parser.add_option(
+            '--limit', dest='limit', type='int', default=20,
+            help='number of functions to report per stage'
+        )
+
+    def command(self):
+        self._load_config()
+        cmd = self.args[0]
+        if cmd == 'profile' and len(self.args) == 2:
+            if self.options.record and self.options.replay:
+                print 'Use either --record or --replay'
+                sys.exit(1)
+            self.profile(self.args[1])
+        elif cmd == 'requeue':
+            self.requeue()
+        else:
+            print 'Command %s not recognized' % cmd
+            sys.exit(1)
+
+    def profile(self, source_id):
+        from pylons import config
+        from ckan import model
+        from ckanext.harvest.model import HarvestJob
+        from ckanext.harvest.model import HarvestSource
+        from profiling import StageProfiler
+
+        source = HarvestSource.get(source_id)
+        if source is None:
+            package = model.Package.get(source_id)
+            source = package and HarvestSource.get(package.id)
+        if source is None:
+            print 'Harvest source %s not found' % source_id
+            sys.exit(1)
+
+        harvester = ProfilingHarvester(
+            self.options.records,
+            self.options.record or self.options.replay,
+            bool(self.options.replay)
+        )
+        harvester.configure(config)
+        # the job is not started by the gather consumer, so it is never
+        # taken as the last harvest by incremental harvests
+        job = HarvestJob(source=source, status=u'Running')
+        job.save()
+
+        profiler = StageProfiler()
+        try:
+            self._run_job(harvester, job, profiler)
+        finally:
+            job.status = u'Finished'
+            job.save()
+
+        report = profiler.report(
+            self.options.limit,
+            restrictions=[r'oaipmh[/\\]metadata\.py']
+        )
+        if self.options.output:
+            with open(self.options.output, 'w') as f:
+                f.write(report)
+            print 'Report written to %s' % self.options.output
+        else:
+            print report
+
+    def requeue(self):
+        from ckanext.harvest.model import HarvestJob
+        from ckanext.harvest.queue import get_gather_publisher
+        from model import OaipmhPartition
+
+        harvester = OaipmhHarvester()
+        publisher = get_gather_publisher()
+        try:
+            for harvest_job_id in OaipmhPartition.unfinished_jobs():
+                job = HarvestJob.get(harvest_job_id)
+                if job is None or job.status == u'Finished':
+                    continue
+                harvester._set_config(job.source.config)
+                if OaipmhPartition.stalled(
+                        harvest_job_id, harvester.partition_lease):
+                    publisher.send({'harvest_job_id': harvest_job_id})
+                    print 'Requeued the partitions of job %s' % harvest_job_id
+        finally:
+            publisher.close()
+
+    def _run_job(self, harvester, job, profiler):
+        from ckanext.harvest.model import HarvestObject
+
+        with profiler.profile('gather'):
+            harvest_obj_ids = harvester.gather_stage(job)
+        if harvest_obj_ids is None:
+            print 'The gather stage failed, see the gather errors of job %s' \
+                % job.id
+            return
+        failed = 0
+        for harvest_obj_id in harvest_obj_ids:
+            harvest_object = HarvestObject.get(harvest_obj_id)
+            with profiler.profile('fetch'):
+                success = harvester.fetch_stage(harvest_object)
+            if success:
+                with profiler.profile('import'):
+                    success = harvester.import_stage(harvest_object)
+            harvest_object.state = u'COMPLETE' if success else u'ERROR'
+            harvest_object.save()
+            failed += 0 if success else 1
+        print '%s objects harvested, %s failed' % (
+            len(harvest_obj_ids), failed
+        )
+
+
+class ProfilingHarvester(OaipmhHarvester):
+    '''
+    A harvester which only harvests the first `records` records of a
+    source, without touching the checkpoint or the capabilities of the
+    source, and saves or replays the responses of the repository in
+    `archive_path` if one is given. As a singleton plugin, the class is
+    instantiated without arguments when it is defined.
+    '''
+
+    _archive_client = None
+
+    def __init__(self, records=100, archive_path=None, replay=False):
+        OaipmhHarvester.__init__(self)
+        self.records = records
+        self.archive_path = archive_path
+        self.replay_responses = replay
+
+    def _set_config(self, source_config):
+        OaipmhHarvester._set_config(self, source_config)
+        # the sample is listed in this process, page after page
+        self.partition = None
+        self.distribute_gather = False
+        self.stream_gather = False
+
+    def _choose_strategy(self, capabilities, harvest_job):
+        OaipmhHarvester._choose_strategy(self, capabilities, harvest_job)
+        self.partition = None
+
+    def _list_pages(self, client, harvest_job):
+        verb = 'ListRecords' if self.list_records else 'ListIdentifiers'
+        pages = list_pages(client, verb, self._listing_args())
+        return _sample(pages, self.records), []
+
+    def _save_checkpoint(self, harvest_job, token, objects_created):
+        pass
+
+    def _save_capabilities(self, harvest_job):
+        pass
+
+    def _create_client(self, url):
+        if self.archive_path is None:
+            return OaipmhHarvester._create_client(self, url)
+        if self._archive_client is None:
+            self._metadata_registry = self._create_metadata_registry()
+            self._archive_client = ArchivingClient(
+                ResponseArchive(self.archive_path),
+                self.replay_responses,
+                url,
+                self._metadata_registry,
+                self.credentials,
+                force_http_get=self.force_http_get,
+                parser=self._response_parser()
+            )
+        return self._archive_client
+
+
+def _sample(pages, records):
+    '''
+    Yield the pages up to the first `records` items, the last page has no
+    resumption token.
+    '''
+    remaining = records
+    for items, token in pages:
+        items = items[:remaining]
+        remaining -= len(items)
+        if remaining <= 0 or token is None:
+            yield items, None
+            return
+        yield items, token
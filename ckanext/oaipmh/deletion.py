@@ -0,0 +1,113 @@
+'''
+Withdrawal of the datasets of records which the repository reports as
+deleted: the datasets of a batch of records are deleted in a single
+transaction and removed from the search index with a single commit,
+instead of fetching and importing every deleted record.
+
+The datasets are deleted with the package_delete action, so that their
+deletion gets a revision and an activity and the IPackageController
+plugins are called, like for any other deleted dataset. They are not
+indexed one by one, the search index is updated once for the batch.
+'''
+import logging
+
+from pylons import config
+
+from ckan import model
+from ckan.logic import NotFound
+from ckan.logic import get_action
+from ckan.model import Session
+from ckan.lib.search.common import make_connection
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import harvest_object_table
+
+from indexing import automatic_indexing_disabled
+
+log = logging.getLogger(__name__)
+
+# number of datasets removed from the search index with one query
+UNINDEX_BATCH_SIZE = 100
+
+
+def withdraw_packages(harvest_source_id, guids, user):
+    '''
+    Delete the active datasets of the current harvest objects of the
+    source with the given guids as `user`, and mark the objects as not
+    current, so that a record which reappears is imported again. Returns
+    the ids of the withdrawn datasets, the caller has to commit and then
+    remove them from the search index with unindex_packages.
+    '''
+    if not guids:
+        return []
+    rows = Session.query(HarvestObject.id, model.Package.id).join(
+        model.Package,
+        model.Package.id == HarvestObject.package_id
+    ).filter(
+        HarvestObject.harvest_source_id == harvest_source_id,
+        HarvestObject.current == True,  # noqa
+        HarvestObject.guid.in_(list(guids)),
+        model.Package.state == model.State.ACTIVE
+    ).all()
+    if not rows:
+        return []
+    object_ids = [object_id for object_id, _ in rows]
+    package_ids = []
+
+    Session.execute(
+        harvest_object_table.update()
+        .where(harvest_object_table.c.id.in_(object_ids))
+        .values(current=False)
+    )
+    with automatic_indexing_disabled():
+        for package_id in set(package_id for _, package_id in rows):
+            if _delete_package(package_id, user):
+                package_ids.append(package_id)
+    log.info('%s datasets withdrawn' % len(package_ids))
+    return package_ids
+
+
+def _delete_package(package_id, user):
+    '''
+    Delete the dataset within a savepoint, which the commit of
+    package_delete releases, so that the deletions of a batch are
+    committed together by the caller. Returns whether it was deleted.
+    '''
+    context = {
+        'model': model,
+        'session': Session,
+        'user': user,
+        'ignore_auth': True,
+    }
+    Session.begin_nested()
+    try:
+        get_action('package_delete')(context, {'id': package_id})
+    except NotFound:
+        Session.rollback()
+        return False
+    return True
+
+
+def unindex_packages(package_ids):
+    '''
+    Remove the withdrawn datasets from the search index with a few delete
+    queries and commit it once. Call it after the withdrawal has been
+    committed.
+    '''
+    if not package_ids:
+        return
+    conn = make_connection()
+    try:
+        for i in range(0, len(package_ids), UNINDEX_BATCH_SIZE):
+            ids = package_ids[i:i + UNINDEX_BATCH_SIZE]
+            conn.delete_query(
+                '+entity_type:package +site_id:"%s" +id:(%s)' % (
+                    config.get('ckan.site_id'),
+                    ' OR '.join('"%s"' % package_id for package_id in ids)
+                )
+            )
+        conn.commit()
+    except Exception:
+        log.exception('Removing %s datasets from the index failed'
+                      % len(package_ids))
+    finally:
+        conn.close()
@@ -0,0 +1,48 @@
+'''
+Concurrent GetRecord requests for the fetch stage.
+'''
+import logging
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+
+class ConcurrentFetcher(object):
+    '''
+    Runs up to `concurrency` GetRecord requests at the same time in a pool
+    of threads. The requests of a client are spaced by its throttle, so
+    the rate limit and the backoff after 503 responses of a source apply
+    to all threads.
+    '''
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._pool = ThreadPool(concurrency)
+
+    def get_records(self, client, identifiers, metadata_prefix):
+        '''
+        Return a (record, exception) tuple for every identifier, in the
+        order of the identifiers. Either the record or the exception
+        raised while getting it is None.
+        '''
+        return self._pool.map(
+            partial(_get_record, client, metadata_prefix),
+            identifiers
+        )
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def _get_record(client, metadata_prefix, identifier):
+    try:
+        record = client.getRecord(
+            identifier=identifier,
+            metadataPrefix=metadata_prefix
+        )
+        return record, None
+    except Exception, e:
+        log.debug('getRecord failed for %s' % identifier, exc_info=True)
+        return None, e
@@ -0,0 +1,81 @@
+'''
+The ids of the objects created by a gather stage, which are either
+returned by the stage, for ckanext-harvest to send them to the fetch
+queue once the stage is done, or sent to the fetch queue right away.
+'''
+import logging
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class GatheredObjects(object):
+    '''
+    Collects the ids of the gathered objects, which are returned by the
+    gather stage.
+    '''
+
+    # whether the objects are in the fetch queue once they are committed
+    queued = False
+
+    def __init__(self):
+        self.count = 0
+        self._ids = []
+
+    def extend(self, ids):
+        self._ids.extend(ids)
+        self.count += len(ids)
+
+    def __len__(self):
+        return self.count
+
+    def committed(self):
+        '''
+        Call after the objects added so far have been committed.
+        '''
+        pass
+
+    def result(self):
+        '''
+        Return the ids the gather stage returns.
+        '''
+        return self._ids
+
+    def close(self):
+        pass
+
+
+class StreamedObjects(GatheredObjects):
+    '''
+    Sends the ids of the gathered objects to the fetch queue with
+    `publisher` as soon as the objects have been committed, and forgets
+    them, so that the memory the gather stage takes does not grow with the
+    size of the repository. The gather stage returns no ids then, the
+    objects sent are counted here instead.
+    '''
+
+    queued = True
+
+    def __init__(self, publisher, description=''):
+        GatheredObjects.__init__(self)
+        self.publisher = publisher
+        self.description = description
+
+    def committed(self):
+        if not self._ids:
+            return
+        for harvest_object_id in self._ids:
+            self.publisher.send({'harvest_object_id': harvest_object_id})
+        metrics.count('objects', len(self._ids), stage='gather')
+        self._ids = []
+        log.info(
+            'Sent %s objects of %s to the fetch queue so far'
+            % (self.count, self.description)
+        )
+
+    def result(self):
+        return []
+
+    def close(self):
+        self.publisher.close()
@@ -1,30 +1,139 @@
+import datetime
 import logging
 import json
+import hashlib
 import urllib2
+import time
 import traceback
+from itertools import chain
 
 from ckan.model import Session
 from ckan.logic import get_action
+from ckan.logic import NotFound
+from ckan.logic import ValidationError
+from ckan.logic.schema import default_create_package_schema
+from ckan.lib.navl.validators import ignore
+from ckan.lib.navl.validators import ignore_missing
 from ckan import model
+from ckan.model.types import make_uuid
+from ckan.plugins import implements
+from ckan.plugins import IConfigurable
 
 from ckanext.harvest.harvesters.base import HarvesterBase
 from ckan.lib.munge import munge_tag
 from ckan.lib.munge import munge_title_to_name
+from ckanext.harvest.model import HarvestJob
 from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra
+from ckanext.harvest.model import harvest_object_table
+from ckanext.harvest.queue import get_fetch_publisher
+from ckanext.harvest.queue import get_gather_publisher
 
-import oaipmh.client
+from lxml import etree
+from oaipmh import common
+from oaipmh import error as oai_error
 from oaipmh.metadata import MetadataRegistry
 
+from metadata import ddi_parser
 from metadata import oai_ddi_reader
 from metadata import oai_dc_reader
+from cache import TTLCache
+from capability import Capabilities
+from cache import memoize
+from codec import decode_content
+from codec import encode_content
+from deletion import unindex_packages
+from deletion import withdraw_packages
+from client import ClientPool
+from client import REQUEST_TIMEOUT
+from fetcher import ConcurrentFetcher
+from gathered import GatheredObjects
+from gathered import StreamedObjects
+from indexing import automatic_indexing_disabled
+from indexing import index_pending
+from indexing import mark_pending
+from jobcontext import JobContext
+from listing import list_pages
+from metrics import instrument
+from metrics import metrics
+from model import OaipmhCapability
+from model import OaipmhCheckpoint
+from model import OaipmhPartition
+from model import OaipmhRecord
+from model import OaipmhReplay
+from model import claim_guids
+from model import forget_guids
+from partition import PartitionedLister
+from pipeline import RecordPipeline
+from partition import date_partitions
+from partition import dump_partition
+from partition import load_partition
+from partition import set_partitions
+from store import RecordStore
+from transform import FieldTransform
+from model import setup as setup_model
 
 log = logging.getLogger(__name__)
 
+# group ids are looked up again after 10 minutes, in case groups are deleted
+GROUP_CACHE_TTL = 600
+# the capabilities of a source are probed again after a day
+CAPABILITY_TTL = 86400
+# number of munged tags and group names which are remembered
+MUNGE_MEMO_SIZE = 10000
+# number of dataset ids which are looked up with a single query
+PACKAGE_ID_BATCH_SIZE = 1000
+# objects whose records a consumer prefetches are marked with this extra
+PREFETCH_KEY = 'prefetching'
+# seconds to wait for a record which another consumer prefetches
+PREFETCH_WAIT = 60
+PREFETCH_POLL = 0.5
+
+# the same tags and groups come up again and again
+_munge_tag = memoize(munge_tag, MUNGE_MEMO_SIZE)
+_munge_name = memoize(munge_title_to_name, MUNGE_MEMO_SIZE)
+
 
 class OaipmhHarvester(HarvesterBase):
     '''
     OAI-PMH Harvester
     '''
+    implements(IConfigurable)
+
+    _client_pool = None
+    _metadata_registry = None
+    _fetcher = None
+    _group_ids = TTLCache(GROUP_CACHE_TTL)
+    _source_config = None
+    _job_context = None
+    _index_pending_count = 0
+    _record_store = None
+    _transform = None
+    _pipeline = None
+    _pipeline_job_id = None
+    # the source of the job or object of the current stage
+    _source_id = None
+    # identifiers of the deleted records listed since the last batch
+    _deleted_guids = None
+    # the ids of the objects created by the current gather stage
+    _gathered = None
+    # the capabilities of the source of the current gather stage
+    _capabilities = None
+    _capability_ttl = CAPABILITY_TTL
+    _request_timeout = REQUEST_TIMEOUT
+
+    def configure(self, config):
+        setup_model()
+        metrics.path = config.get('ckanext.oaipmh.metrics_file')
+        store_path = config.get('ckanext.oaipmh.record_store')
+        if store_path:
+            OaipmhHarvester._record_store = RecordStore(store_path)
+        OaipmhHarvester._capability_ttl = int(config.get(
+            'ckanext.oaipmh.capability_ttl', CAPABILITY_TTL
+        ))
+        OaipmhHarvester._request_timeout = float(config.get(
+            'ckanext.oaipmh.request_timeout', REQUEST_TIMEOUT
+        ))
 
     def info(self):
         '''
@@ -36,6 +145,7 @@ class OaipmhHarvester(HarvesterBase):
             'description': 'Harvester for OAI-PMH data sources'
         }
 
+    @instrument('gather')
     def gather_stage(self, harvest_job):
         '''
         The gather stage will recieve a HarvestJob object and will be
@@ -53,25 +163,15 @@ class OaipmhHarvester(HarvesterBase):
         '''
         log.debug("in gather stage: %s" % harvest_job.source.url)
         try:
-            harvest_obj_ids = []
-            registry = self._create_metadata_registry()
             self._set_config(harvest_job.source.config)
-            client = oaipmh.client.Client(
-                harvest_job.source.url,
-                registry,
-                self.credentials,
-                force_http_get=self.force_http_get
-            )
-
-            client.identify()  # check if identify works
-            for header in self._identifier_generator(client):
-                harvest_obj = HarvestObject(
-                    guid=header.identifier(),
-                    job=harvest_job
-                )
-                harvest_obj.save()
-                harvest_obj_ids.append(harvest_obj.id)
-                log.debug("Harvest obj %s created" % harvest_obj.id)
+            self._source_id = harvest_job.source.id
+            self._deleted_guids = set()
+            self._gathered = self._gathered_objects(harvest_job)
+            try:
+                self._gather_objects(harvest_job)
+            finally:
+                self._gathered.close()
+            harvest_obj_ids = self._gathered.result()
         except urllib2.HTTPError, e:
             log.exception(
                 'Gather stage failed on %s (%s): %s, %s'
@@ -103,24 +203,655 @@ class OaipmhHarvester(HarvesterBase):
             return None
         log.debug(
             "Gather stage successfully finished with %s harvest objects"
-            % len(harvest_obj_ids)
+            % len(self._gathered)
         )
         return harvest_obj_ids
 
-    def _identifier_generator(self, client):
+    def _gathered_objects(self, harvest_job):
+        """
+        With stream_gather, the objects are sent to the fetch queue batch
+        by batch instead of being returned by the gather stage. So are the
+        objects of distributed gathers, which lets another consumer take
+        over a partition without losing the objects saved before.
+        """
+        if self.stream_gather or self.distribute_gather:
+            return StreamedObjects(
+                get_fetch_publisher(),
+                harvest_job.source.url
+            )
+        return GatheredObjects()
+
+    def _gather_objects(self, harvest_job):
+        """
+        Gather the objects of the job in the way the source is configured
+        for, they are added to self._gathered.
+        """
+        if self.replay:
+            self._gather_replay(harvest_job)
+            return
+        client = self._create_client(harvest_job.source.url)
+
+        capabilities = self._get_capabilities(client, harvest_job)
+        self._set_from_date(client, capabilities, harvest_job)
+        if self.strategy == 'auto':
+            self._choose_strategy(capabilities, harvest_job)
+        if self.partition and self.distribute_gather:
+            self._gather_distributed(client, capabilities, harvest_job)
+        elif self.partition:
+            self._gather_partitioned(client, capabilities, harvest_job)
+        else:
+            self._gather(client, harvest_job)
+        self._save_capabilities(harvest_job)
+
+    def _get_capabilities(self, client, harvest_job):
+        """
+        Return the capabilities of the source, which are probed again if
+        they are older than the capability TTL or the URL of the source
+        has changed. The measurements of the list pages are kept.
+        """
+        source = harvest_job.source
+        saved = OaipmhCapability.get(source.id)
+        if saved is not None and saved.url == source.url:
+            age = datetime.datetime.utcnow() - saved.probed
+            capabilities = Capabilities.load(saved.capabilities)
+            if age.days * 86400 + age.seconds < self._capability_ttl:
+                self._capabilities = capabilities
+                return capabilities
+            probed = Capabilities.probe(client)
+            probed.pages = capabilities.pages
+            probed.records = capabilities.records
+            capabilities = probed
+        else:
+            capabilities = Capabilities.probe(client)
+        log.info(
+            'Probed %s: granularity %s, deleted records %s, formats %s, '
+            '%s sets' % (
+                source.url, capabilities.granularity,
+                capabilities.deleted_record,
+                ', '.join(capabilities.metadata_prefixes),
+                len(capabilities.sets)
+            )
+        )
+        if saved is None:
+            saved = OaipmhCapability(harvest_source_id=source.id)
+        saved.url = source.url
+        saved.capabilities = capabilities.dump()
+        saved.probed = datetime.datetime.utcnow()
+        saved.add()
+        Session.commit()
+        self._capabilities = capabilities
+        return capabilities
+
+    def _save_capabilities(self, harvest_job):
+        """
+        Save the measurements of the listing, and the number of records
+        if all records of the source have been listed by this consumer.
+        """
+        capabilities = self._capabilities
+        if self.from_date is None and not (
+                self.partition and self.distribute_gather):
+            capabilities.records = len(self._gathered)
+        saved = OaipmhCapability.get(harvest_job.source.id)
+        if saved is not None:
+            saved.capabilities = capabilities.dump()
+            saved.add()
+            Session.commit()
+
+    def _choose_strategy(self, capabilities, harvest_job):
+        """
+        Harvest the source the cheapest way its capabilities allow, the
+        options set in the configuration of the source are kept.
+        """
+        strategy = capabilities.strategy(
+            self.md_format,
+            full=self.from_date is None
+        )
+        for key, value in strategy.items():
+            if key not in self._configured:
+                setattr(self, key, value)
+        log.info(
+            'Harvest %s with list_records=%s, partition=%s'
+            % (harvest_job.source.url, self.list_records, self.partition)
+        )
+
+    def _gather(self, client, harvest_job):
+        """
+        List the source page by page and save the objects in batches,
+        with a checkpoint to continue from after each batch.
+        """
+        pages, adopted_ids = self._list_pages(client, harvest_job)
+        gathered = self._gathered
+        gathered.extend(adopted_ids)
+        pending = []
+        for items, token in pages:
+            pending.extend(self._page_items(items))
+            if token is None or len(pending) >= self.gather_batch_size:
+                gathered.extend(
+                    self._save_harvest_objects(harvest_job, pending)
+                )
+                self._save_checkpoint(harvest_job, token, len(gathered))
+                self._commit_batch(harvest_job)
+                pending = []
+
+    def _gather_replay(self, harvest_job):
+        """
+        Create an object for every record of the source in the record
+        store, the fetch stage reads them from the store instead of the
+        repository.
+        """
+        OaipmhReplay(harvest_job_id=harvest_job.id).add()
+        records = Session.query(OaipmhRecord.guid).filter(
+            OaipmhRecord.harvest_source_id == harvest_job.source.id,
+            OaipmhRecord.metadata_prefix == self.md_format
+        ).yield_per(self.gather_batch_size)
+        gathered = self._gathered
+        pending = []
+        for record in records:
+            pending.append(
+                (common.Header(None, record.guid, None, [], False), None)
+            )
+            if len(pending) >= self.gather_batch_size:
+                gathered.extend(
+                    self._save_harvest_objects(harvest_job, pending)
+                )
+                pending = []
+        gathered.extend(self._save_harvest_objects(harvest_job, pending))
+        Session.commit()
+        gathered.committed()
+        log.info(
+            'Replay %s stored records of %s'
+            % (len(gathered), harvest_job.source.url)
+        )
+
+    def _gather_partitioned(self, client, capabilities, harvest_job):
+        """
+        List the partitions of the source at the same time and save the
+        objects in batches. A record listed in several partitions is only
+        gathered once. There is no checkpoint, an interrupted partitioned
+        gather starts from scratch. With stream_gather, the records which
+        have been gathered are looked up in the database batch by batch
+        instead of being kept in memory.
+        """
+        verb = 'ListRecords' if self.list_records else 'ListIdentifiers'
+        partitions = self._partitions(client, capabilities)
+        log.info(
+            'List %s in %s partitions by %s'
+            % (harvest_job.source.url, len(partitions), self.partition)
+        )
+        lister = PartitionedLister(self.partition_concurrency)
+        pages = lister.list_pages(
+            client, verb, self._listing_args(), partitions
+        )
+        if self.stream_gather:
+            # left behind by gathers of the source which failed
+            forget_guids(harvest_job.source.id, except_job_id=harvest_job.id)
+        guids = set()
+        pending = []
+        for items in pages:
+            pending.extend(
+                items if self.stream_gather else
+                [item for item in items if self._is_new(item, guids)]
+            )
+            if len(pending) >= self.gather_batch_size:
+                self._save_partitioned_batch(harvest_job, pending)
+                pending = []
+        self._save_partitioned_batch(harvest_job, pending)
+        if self.stream_gather:
+            forget_guids(harvest_job.source.id)
+            Session.commit()
+
+    def _save_partitioned_batch(self, harvest_job, items):
+        if self.stream_gather:
+            harvest_obj_ids = self._save_new_harvest_objects(
+                harvest_job, items
+            )
+        else:
+            harvest_obj_ids = self._save_harvest_objects(
+                harvest_job, self._page_items(items)
+            )
+        self._gathered.extend(harvest_obj_ids)
+        self._commit_batch(harvest_job)
+
+    def _gather_distributed(self, client, capabilities, harvest_job):
+        """
+        Gather the partitions of the job which no other gather consumer has
+        taken on. The consumer of the first gather message of the job
+        splits the listing and publishes another gather message for every
+        other partition, so that they are taken on by the other gather
+        consumers. Once no partition is left to claim, the consumer is done
+        with the message, even if other consumers are still gathering. A
+        partition which has not saved a batch for `partition_lease` seconds
+        is claimed again by the consumer of the next gather message of the
+        job, see the requeue command.
+        """
+        if not OaipmhPartition.for_job(harvest_job.id):
+            self._create_partitions(client, capabilities, harvest_job)
+        partition = OaipmhPartition.claim(harvest_job.id, self.partition_lease)
+        while partition is not None:
+            self._gather_claimed_partition(client, harvest_job, partition)
+            partition = OaipmhPartition.claim(
+                harvest_job.id, self.partition_lease
+            )
+        if not OaipmhPartition.left(harvest_job.id):
+            forget_guids(harvest_job.source.id)
+            Session.commit()
+        log.info('No partition of job %s left to claim' % harvest_job.id)
+
+    def _gather_claimed_partition(self, client, harvest_job, partition):
+        try:
+            self._gather_partition(client, harvest_job, partition)
+        except Exception:
+            Session.rollback()
+            self._finish_partition(partition, u'ERROR')
+            raise
+        self._finish_partition(partition, u'DONE')
+
+    def _create_partitions(self, client, capabilities, harvest_job):
+        """
+        Save the partitions of the job and publish a gather message for
+        each of them but the one gathered by this consumer. Every
+        partition has a placeholder object until it has been gathered,
+        which keeps the job from being marked as finished too early.
+        ckanext-harvest sets the gather start of the job again for every
+        gather message, so the start of this gather is kept with the
+        partitions.
+        """
+        started = harvest_job.gather_started or datetime.datetime.utcnow()
+        partitions = self._partitions(client, capabilities)
+        for args in partitions:
+            placeholder = HarvestObject(
+                id=make_uuid(),
+                guid=u'oaipmh-partition',
+                job=harvest_job,
+                harvest_source_id=harvest_job.source.id,
+                state=u'GATHERING'
+            )
+            placeholder.add()
+            OaipmhPartition(
+                harvest_job_id=harvest_job.id,
+                args=dump_partition(args),
+                placeholder_id=placeholder.id,
+                created=started
+            ).add()
+        # left behind by gathers of the source which failed
+        forget_guids(harvest_job.source.id, except_job_id=harvest_job.id)
+        Session.commit()
+        log.info(
+            'Distribute %s partitions of %s'
+            % (len(partitions), harvest_job.source.url)
+        )
+        publisher = get_gather_publisher()
+        for _ in partitions[1:]:
+            publisher.send({'harvest_job_id': harvest_job.id})
+        publisher.close()
+
+    def _gather_partition(self, client, harvest_job, partition):
+        """
+        List a partition and save the objects in batches. Records which
+        another partition of the job, or a consumer which has gathered the
+        partition before, has saved already are left out. Every batch
+        renews the lease of the partition.
+        """
+        verb = 'ListRecords' if self.list_records else 'ListIdentifiers'
+        args = dict(self._listing_args(), **load_partition(partition.args))
+        pending = []
+        pages = list_pages(
+            client, verb, args, observe=self._capabilities.observe_page
+        )
+        for items, token in pages:
+            pending.extend(items)
+            if token is None or len(pending) >= self.gather_batch_size:
+                harvest_obj_ids = self._save_new_harvest_objects(
+                    harvest_job, pending
+                )
+                self._gathered.extend(harvest_obj_ids)
+                partition.objects_created += len(harvest_obj_ids)
+                partition.updated = datetime.datetime.utcnow()
+                self._commit_batch(harvest_job)
+                pending = []
+
+    def _save_new_harvest_objects(self, harvest_job, items):
+        """
+        Save the objects of the listed items whose identifiers have not
+        been gathered by the job yet, the caller has to commit. The
+        identifiers are claimed in the database, so that a record listed
+        by several consumers at the same time is only gathered once.
+        """
+        listed = set()
+        items = [item for item in items if self._is_new(item, listed)]
+        new_guids = set(claim_guids(
+            harvest_job.source.id,
+            harvest_job.id,
+            [self._item_header(item).identifier() for item in items]
+        ))
+        return self._save_harvest_objects(harvest_job, self._page_items([
+            item for item in items
+            if self._item_header(item).identifier() in new_guids
+        ]))
+
+    def _finish_partition(self, partition, state):
+        placeholder = HarvestObject.get(partition.placeholder_id)
+        if placeholder is not None:
+            placeholder.delete()
+        partition.state = state
+        partition.save()
+
+    def _partitions(self, client, capabilities):
+        if self.partition == 'sets':
+            return set_partitions(client, self.set_spec)
+        if self.partition == 'dates':
+            partitions = date_partitions(
+                self.from_date or capabilities.earliest_datestamp,
+                self.partition_windows,
+                client._day_granularity
+            )
+            # do not rely on the earliest datestamp being right
+            partitions[0]['from_'] = self.from_date
+            return partitions
+        raise ValueError('Unknown partition mode: %s' % self.partition)
+
+    def _is_new(self, item, guids):
+        """
+        Check whether the listed item has not been seen before, and
+        remember it.
+        """
+        guid = self._item_header(item).identifier()
+        if guid in guids:
+            return False
+        guids.add(guid)
+        return True
+
+    def _item_header(self, item):
+        return item[0] if self.list_records else item
+
+    def _list_pages(self, client, harvest_job):
+        """
+        Start listing the source, or continue the listing of a previous
+        gather that failed if there is a checkpoint for the source. Returns
+        a generator of pages and the ids of the objects which have been
+        gathered before the failure and still have to be sent to the fetch
+        queue. A checkpoint of a listing with another verb or other
+        arguments, e.g. after the configuration of the source has been
+        changed, is discarded together with its waiting objects.
+        """
+        verb = 'ListRecords' if self.list_records else 'ListIdentifiers'
+        args = self._listing_args()
+        checkpoint = OaipmhCheckpoint.get(harvest_job.source.id)
+        if checkpoint is not None and not self._same_listing(
+                checkpoint, verb, args):
+            log.info(
+                'Listing of %s has changed, discard its checkpoint'
+                % harvest_job.source.url
+            )
+            checkpoint.delete()
+            self._discard_harvest_objects(checkpoint.harvest_job_id)
+            checkpoint = None
+        if checkpoint is not None:
+            pages = list_pages(
+                client, verb, args, checkpoint.resumption_token,
+                observe=self._capabilities.observe_page
+            )
+            try:
+                first_page = next(pages)
+            except oai_error.BadResumptionTokenError:
+                log.info(
+                    'Resumption token of %s expired, restart the listing'
+                    % harvest_job.source.url
+                )
+                self._discard_harvest_objects(checkpoint.harvest_job_id)
+            else:
+                log.info(
+                    'Continue listing %s after %s objects'
+                    % (harvest_job.source.url, checkpoint.objects_created)
+                )
+                harvest_obj_ids = self._adopt_harvest_objects(
+                    checkpoint.harvest_job_id, harvest_job
+                )
+                if checkpoint.objects_queued:
+                    # a streamed gather has sent them already
+                    harvest_obj_ids = []
+                return chain([first_page], pages), harvest_obj_ids
+        pages = list_pages(
+            client, verb, args, observe=self._capabilities.observe_page
+        )
+        return pages, []
+
+    def _same_listing(self, checkpoint, verb, args):
+        if checkpoint.verb != verb or checkpoint.args is None:
+            return False
+        return json.loads(checkpoint.args) == json.loads(dump_partition(args))
+
+    def _adopt_harvest_objects(self, old_job_id, harvest_job):
+        """
+        Move the objects an interrupted gather left waiting to this job.
+        Returns their ids.
+        """
+        objs = Session.query(HarvestObject.id).filter(
+            HarvestObject.harvest_job_id == old_job_id,
+            HarvestObject.state == u'WAITING'
+        )
+        harvest_obj_ids = [obj.id for obj in objs]
+        if harvest_obj_ids:
+            Session.execute(
+                harvest_object_table.update()
+                .where(harvest_object_table.c.id.in_(harvest_obj_ids))
+                .values(harvest_job_id=harvest_job.id)
+            )
+        return harvest_obj_ids
+
+    def _discard_harvest_objects(self, old_job_id):
+        """
+        Delete the objects an interrupted gather left waiting, as the
+        listing starts over and gathers them again. Without them, the
+        interrupted job can be marked as finished.
+        """
+        result = Session.execute(
+            harvest_object_table.delete()
+            .where(harvest_object_table.c.harvest_job_id == old_job_id)
+            .where(harvest_object_table.c.state == u'WAITING')
+        )
+        Session.commit()
+        log.info(
+            'Deleted %s objects left waiting by job %s'
+            % (result.rowcount, old_job_id)
+        )
+
+    def _save_checkpoint(self, harvest_job, token, objects_created):
+        """
+        Remember the resumption token of the next page to list, or forget
+        it once the listing is complete.
+        """
+        checkpoint = OaipmhCheckpoint.get(harvest_job.source.id)
+        if token is None:
+            if checkpoint is not None:
+                checkpoint.delete()
+            return
+        if checkpoint is None:
+            checkpoint = OaipmhCheckpoint(
+                harvest_source_id=harvest_job.source.id
+            )
+        checkpoint.harvest_job_id = harvest_job.id
+        checkpoint.verb = (
+            'ListRecords' if self.list_records else 'ListIdentifiers'
+        )
+        checkpoint.args = dump_partition(self._listing_args())
+        checkpoint.resumption_token = token
+        checkpoint.objects_created = objects_created
+        checkpoint.objects_queued = self._gathered.queued
+        checkpoint.add()
+
+    def _page_items(self, items):
+        """
+        Return a (header, content) tuple for every item of a listed page.
+        Deleted records get no object, they are collected to withdraw
+        their datasets with the batch.
+        """
+        items = [item for item in items if not self._collect_deleted(item)]
+        if self.list_records:
+            return list(self._record_items(items))
+        return [(header, None) for header in items]
+
+    def _collect_deleted(self, item):
+        header = self._item_header(item)
+        if not header.isDeleted():
+            return False
+        self._deleted_guids.add(header.identifier())
+        return True
+
+    def _commit_batch(self, harvest_job):
+        """
+        Commit a batch of gathered objects together with the withdrawal of
+        the datasets of the deleted records listed since the last batch.
+        Committing them per batch keeps the deletions in step with the
+        checkpoint of the listing.
+        """
+        guids, self._deleted_guids = self._deleted_guids, set()
+        package_ids = self._withdraw_deleted(harvest_job.source.id, guids)
+        Session.commit()
+        self._gathered.committed()
+        unindex_packages(package_ids)
+
+    def _withdraw_deleted(self, harvest_source_id, guids):
+        """
+        Withdraw the datasets of the deleted records and forget their
+        stored metadata, so that a replay does not bring them back.
+        Returns the ids of the withdrawn datasets, the caller has to
+        commit.
+        """
+        if not guids:
+            return []
+        log.debug('%s records have been deleted' % len(guids))
+        metrics.count('deleted', len(guids))
+        Session.query(OaipmhRecord).filter(
+            OaipmhRecord.harvest_source_id == harvest_source_id,
+            OaipmhRecord.guid.in_(list(guids))
+        ).delete(synchronize_session=False)
+        return withdraw_packages(harvest_source_id, guids, self.user)
+
+    def _save_harvest_objects(self, harvest_job, items):
+        """
+        Insert the HarvestObjects for a batch of (header, content) tuples
+        with a single statement, instead of saving each object on its own.
+        Returns the ids of the new objects, the caller has to commit.
+        """
+        rows = [
+            {
+                'id': make_uuid(),
+                'guid': header.identifier(),
+                'content': content,
+                'harvest_job_id': harvest_job.id,
+                'harvest_source_id': harvest_job.source.id,
+            }
+            for header, content in items
+        ]
+        if rows:
+            Session.execute(harvest_object_table.insert(), rows)
+        log.debug("%s harvest objects created" % len(rows))
+        return [row['id'] for row in rows]
+
+    def _listing_args(self):
         """
         pyoai generates the URL based on the given method parameters
         Therefore one may not use the set parameter if it is not there
         """
+        args = {'metadataPrefix': self.md_format}
         if self.set_spec:
-            for header in client.listIdentifiers(
-                    metadataPrefix=self.md_format,
-                    set=self.set_spec):
-                yield header
-        else:
-            for header in client.listIdentifiers(
-                    metadataPrefix=self.md_format):
-                yield header
+            args['set'] = self.set_spec
+        if self.from_date:
+            args['from_'] = self.from_date
+        return args
+
+    def _set_from_date(self, client, capabilities, harvest_job):
+        """
+        For incremental harvests only the records changed since the start
+        of the last successful job of this source are listed. The from
+        argument has to match the granularity of the repository.
+        """
+        # pyoai offers no public way to set the granularity without
+        # issuing another Identify request
+        client._day_granularity = capabilities.day_granularity
+        self.from_date = None
+        if not self.incremental or self.force_full:
+            return
+        self.from_date = self._get_last_harvest_date(harvest_job)
+        log.debug('Harvest records changed since %s' % self.from_date)
+
+    def _get_last_harvest_date(self, harvest_job):
+        """
+        Return the start of the last job of the same source which finished
+        without gather errors and without failed objects, or None if there
+        is no such job. Jobs which replayed the record store do not count.
+        The start of a job whose partitions have been gathered by several
+        consumers is kept with the partitions.
+        """
+        last_job = Session.query(HarvestJob).filter(
+            HarvestJob.source_id == harvest_job.source_id,
+            HarvestJob.id != harvest_job.id,
+            HarvestJob.status == u'Finished',
+            HarvestJob.gather_started != None,  # noqa
+            ~HarvestJob.gather_errors.any(),
+            ~HarvestJob.objects.any(HarvestObject.state == u'ERROR'),
+            ~HarvestJob.id.in_(Session.query(OaipmhReplay.harvest_job_id))
+        ).order_by(HarvestJob.gather_started.desc()).first()
+        if last_job is None:
+            return None
+        return (
+            OaipmhPartition.job_started(last_job.id) or
+            last_job.gather_started
+        )
+
+    def _record_items(self, records):
+        """
+        Yield the header of each listed record together with the
+        serialized content, so that no GetRecord is needed later on.
+        If the content of a record can not be dumped, None is yielded
+        instead and the fetch stage falls back to GetRecord.
+        """
+        for header, metadata, _ in records:
+            if metadata is None:
+                log.debug('No metadata for %s, skipping' % header.identifier())
+                continue
+            try:
+                content = self._dump_content(header, metadata)
+            except Exception:
+                log.exception(
+                    'Dumping the metadata of %s failed, fetch it later'
+                    % header.identifier()
+                )
+                content = None
+            yield header, content
+
+    def _create_client(self, url):
+        """
+        Return a client for the repository, the clients are kept in a pool
+        so that the fetch stage reuses the connections of a source.
+        """
+        if self._client_pool is None:
+            self._client_pool = ClientPool()
+            self._metadata_registry = self._create_metadata_registry()
+        client = self._client_pool.get(
+            url,
+            self._metadata_registry,
+            self.credentials,
+            force_http_get=self.force_http_get,
+            parser=self._response_parser(),
+            timeout=self._request_timeout
+        )
+        client.throttle.rate = self.fetch_rate
+        return client
+
+    def _response_parser(self):
+        """
+        DDI codebooks are pruned while they are parsed, the responses of
+        other formats are parsed with lxml as a whole, which is faster.
+        Records which are kept in the record store are not pruned, so that
+        the store holds the whole metadata of the record.
+        """
+        if self.store_records and not self.replay:
+            return None
+        if self.md_format == 'oai_ddi':
+            return ddi_parser
+        return None
 
     def _create_metadata_registry(self):
         registry = MetadataRegistry()
@@ -129,6 +860,11 @@ class OaipmhHarvester(HarvesterBase):
         return registry
 
     def _set_config(self, source_config):
+        # a source which has been saved without configuration
+        source_config = source_config or '{}'
+        if source_config == self._source_config:
+            # the attributes are already set from this configuration
+            return
         try:
             config_json = json.loads(source_config)
             log.debug('config_json: %s' % config_json)
@@ -143,10 +879,50 @@ class OaipmhHarvester(HarvesterBase):
             self.set_spec = config_json.get('set', None)
             self.md_format = config_json.get('metadata_prefix', 'oai_dc')
             self.force_http_get = config_json.get('force_http_get', False)
+            self.list_records = config_json.get('list_records', False)
+            self.incremental = config_json.get('incremental', False)
+            self.force_full = config_json.get('force_full', False)
+            self.gather_batch_size = int(
+                config_json.get('gather_batch_size', 500)
+            )
+            self.fetch_concurrency = int(
+                config_json.get('fetch_concurrency', 1)
+            )
+            self.fetch_rate = config_json.get('fetch_rate', None)
+            self.pipeline = config_json.get('pipeline', False)
+            self.pipeline_depth = int(config_json.get('pipeline_depth', 10))
+            self.skip_unchanged = config_json.get('skip_unchanged', True)
+            self.defer_indexing = config_json.get('defer_indexing', False)
+            self.index_batch_size = int(
+                config_json.get('index_batch_size', 100)
+            )
+            self.partition = config_json.get('partition', None)
+            self.partition_concurrency = int(
+                config_json.get('partition_concurrency', 4)
+            )
+            self.partition_windows = int(
+                config_json.get('partition_windows', 16)
+            )
+            self.distribute_gather = config_json.get(
+                'distribute_gather', False
+            )
+            self.partition_lease = int(
+                config_json.get('partition_lease', 1800)
+            )
+            self.stream_gather = config_json.get('stream_gather', False)
+            self.strategy = config_json.get('strategy', None)
+            self._configured = set(config_json)
+            self.compress_content = config_json.get(
+                'compress_content', False
+            )
+            self.store_records = config_json.get('store_records', False)
+            self.replay = config_json.get('replay', False)
+            self._source_config = source_config
 
         except ValueError:
             pass
 
+    @instrument('fetch')
     def fetch_stage(self, harvest_object):
         '''
         The fetch stage will receive a HarvestObject object and will be
@@ -162,15 +938,17 @@ class OaipmhHarvester(HarvesterBase):
         :returns: True if everything went right, False if errors were found
         '''
         log.debug("in fetch stage: %s" % harvest_object.guid)
+        if harvest_object.content:
+            # the content has already been stored by the gather stage
+            log.debug('content of %s already gathered' % harvest_object.guid)
+            return True
         try:
             self._set_config(harvest_object.job.source.config)
-            registry = self._create_metadata_registry()
-            client = oaipmh.client.Client(
-                harvest_object.job.source.url,
-                registry,
-                self.credentials,
-                force_http_get=self.force_http_get
-            )
+            self._source_id = harvest_object.harvest_source_id
+            if self._wait_for_prefetch(harvest_object):
+                log.debug('content of %s prefetched' % harvest_object.guid)
+                return True
+            client = self._create_client(harvest_object.job.source.url)
             record = None
             try:
                 log.debug(
@@ -178,12 +956,7 @@ class OaipmhHarvester(HarvesterBase):
                     (harvest_object.guid, self.md_format)
                 )
 
-                self._before_record_fetch(harvest_object)
-                record = client.getRecord(
-                    identifier=harvest_object.guid,
-                    metadataPrefix=self.md_format
-                )
-                self._after_record_fetch(record)
+                record = self._get_record(client, harvest_object)
                 log.debug('record found!')
             except:
                 log.exception('getRecord failed for %s' % harvest_object.guid)
@@ -196,19 +969,11 @@ class OaipmhHarvester(HarvesterBase):
             header, metadata, _ = record
             log.debug('metadata %s' % metadata)
             log.debug('header %s' % header)
+            if header.isDeleted():
+                return self._fetch_deleted(harvest_object)
 
             try:
-                metadata_modified = header.datestamp().isoformat()
-            except:
-                metadata_modified = None
-
-            try:
-                content_dict = metadata.getMap()
-                content_dict['set_spec'] = header.setSpec()
-                if metadata_modified:
-                    content_dict['metadata_modified'] = metadata_modified
-                log.debug(content_dict)
-                content = json.dumps(content_dict)
+                content = self._dump_content(header, metadata)
             except:
                 log.exception('Dumping the metadata failed!')
                 self._save_object_error(
@@ -232,12 +997,326 @@ class OaipmhHarvester(HarvesterBase):
 
         return True
 
+    def _fetch_deleted(self, harvest_object):
+        """
+        The record has been deleted since the gather stage: withdraw its
+        dataset and leave nothing to import.
+        """
+        log.info('%s has been deleted' % harvest_object.guid)
+        package_ids = self._withdraw_deleted(
+            harvest_object.harvest_source_id,
+            [harvest_object.guid]
+        )
+        harvest_object.content = encode_content(
+            json.dumps({'deleted': True})
+        )
+        harvest_object.save()
+        unindex_packages(package_ids)
+        return True
+
+    def _get_record(self, client, harvest_object):
+        if self.replay:
+            return self._replay_record(harvest_object)
+        if self.pipeline:
+            return self._get_record_pipelined(client, harvest_object)
+        if self.fetch_concurrency > 1:
+            return self._get_records_concurrently(client, harvest_object)
+        self._before_record_fetch(harvest_object)
+        record = client.getRecord(
+            identifier=harvest_object.guid,
+            metadataPrefix=self.md_format
+        )
+        self._after_record_fetch(record)
+        return record
+
+    def _get_records_concurrently(self, client, harvest_object):
+        """
+        Get the record of the harvest object together with the records of
+        the next waiting objects of the job, and store the content of the
+        latter right away. Their own fetch stage has nothing to do then,
+        or falls back to GetRecord if prefetching them failed. The next
+        objects are claimed first, so that the other consumers neither
+        prefetch them as well nor request them again.
+        """
+        harvest_objs = [harvest_object] + self._claim_readahead_objects(
+            harvest_object,
+            self.fetch_concurrency - 1
+        )
+        for obj in harvest_objs:
+            self._before_record_fetch(obj)
+        results = self._get_fetcher().get_records(
+            client,
+            [obj.guid for obj in harvest_objs],
+            self.md_format
+        )
+        for obj, (record, e) in zip(harvest_objs[1:], results[1:]):
+            self._store_prefetched_record(obj, record, e)
+        self._release_prefetches([obj.id for obj in harvest_objs[1:]])
+
+        record, e = results[0]
+        if e is not None:
+            raise e
+        self._after_record_fetch(record)
+        return record
+
+    def _get_record_pipelined(self, client, harvest_object):
+        """
+        Take the record of the harvest object from the pipeline, or get it
+        right away if it has not been put into it, after putting the next
+        waiting objects of the job into the pipeline. The records of other
+        objects which are ready are stored with them, so that their own
+        fetch stage has nothing to do, or falls back to GetRecord if
+        getting them failed. Only objects claimed by this consumer are put
+        into the pipeline, they leave it with their record or error.
+        """
+        pipeline = self._get_pipeline(client, harvest_object)
+        in_pipeline = harvest_object.id in pipeline
+        self._fill_pipeline(pipeline, harvest_object)
+        record = None
+        error = None
+        ready = pipeline.take(harvest_object.id if in_pipeline else None)
+        for obj_id, ready_record, e in ready:
+            if obj_id == harvest_object.id:
+                record, error = ready_record, e
+                continue
+            obj = HarvestObject.get(obj_id)
+            if obj is not None:
+                self._store_prefetched_record(obj, ready_record, e)
+        self._release_prefetches([obj_id for obj_id, _, _ in ready])
+        if error is not None:
+            raise error
+        if record is None:
+            self._before_record_fetch(harvest_object)
+            record = client.getRecord(
+                identifier=harvest_object.guid,
+                metadataPrefix=self.md_format
+            )
+        self._after_record_fetch(record)
+        return record
+
+    def _get_pipeline(self, client, harvest_object):
+        """
+        Return the pipeline of the job of the harvest object, the pipeline
+        of the previous job is closed.
+        """
+        job_id = harvest_object.harvest_job_id
+        if (self._pipeline is None or self._pipeline.client is not client or
+                self._pipeline_job_id != job_id or
+                self._pipeline.metadata_prefix != self.md_format):
+            if self._pipeline is not None:
+                self._pipeline.close()
+                self._release_prefetches(
+                    [obj_id for obj_id, _, _ in self._pipeline.take()]
+                )
+            self._pipeline = RecordPipeline(client, self.md_format)
+            self._pipeline_job_id = job_id
+        return self._pipeline
+
+    def _fill_pipeline(self, pipeline, harvest_object):
+        """
+        Put the next waiting objects of the job into the pipeline, until
+        `pipeline_depth` records are in it. The depth bounds the memory
+        the pipeline takes and how far it runs ahead of the imports.
+        """
+        free = self.pipeline_depth - pipeline.outstanding()
+        if free <= 0:
+            return
+        for obj in self._claim_readahead_objects(harvest_object, free):
+            self._before_record_fetch(obj)
+            pipeline.put(obj.guid, obj.id)
+
+    def _readahead_objects(self, harvest_object, limit):
+        return Session.query(HarvestObject).filter(
+            HarvestObject.harvest_job_id == harvest_object.harvest_job_id,
+            HarvestObject.id != harvest_object.id,
+            HarvestObject.state == u'WAITING',
+            HarvestObject.content == None  # noqa
+        ).order_by(HarvestObject.gathered).limit(limit).all()
+
+    def _claim_readahead_objects(self, harvest_object, limit):
+        """
+        Return up to `limit` of the next waiting objects of the job after
+        claiming them for prefetching their records. Objects claimed by
+        another consumer, or whose own fetch stage has begun, are left
+        out. A failed prefetch is not retried, the own fetch stage of the
+        object requests the record then. The claims are committed right
+        away, so that the consumer which receives a claimed object waits
+        for its record instead of requesting it once more.
+        """
+        objs = self._readahead_objects(harvest_object, limit)
+        if not objs:
+            return []
+        claimed = set(row[0] for row in Session.execute(
+            harvest_object_table.update().where(
+                harvest_object_table.c.id.in_([obj.id for obj in objs])
+            ).where(
+                harvest_object_table.c.state == u'WAITING'
+            ).values(
+                state=u'FETCH'
+            ).returning(harvest_object_table.c.id)
+        ))
+        objs = [obj for obj in objs if obj.id in claimed]
+        claimed_at = datetime.datetime.utcnow().isoformat()
+        for obj in objs:
+            HarvestObjectExtra(
+                harvest_object_id=obj.id,
+                key=PREFETCH_KEY,
+                value=claimed_at
+            ).add()
+        Session.commit()
+        return objs
+
+    def _release_prefetches(self, harvest_object_ids):
+        """
+        Drop the claims on objects whose records have been stored, or could
+        not be prefetched. Committed together with the object being
+        fetched.
+        """
+        if not harvest_object_ids:
+            return
+        Session.query(HarvestObjectExtra).filter(
+            HarvestObjectExtra.harvest_object_id.in_(harvest_object_ids),
+            HarvestObjectExtra.key == PREFETCH_KEY
+        ).delete(synchronize_session=False)
+
+    def _wait_for_prefetch(self, harvest_object):
+        """
+        If another consumer has claimed the object to prefetch its record,
+        wait until it has stored the content or given up, for at most
+        PREFETCH_WAIT seconds. Returns whether the content has been stored.
+        """
+        if self.replay or not (self.pipeline or self.fetch_concurrency > 1):
+            return False
+        if self._pipeline is not None and harvest_object.id in self._pipeline:
+            # claimed by this consumer, taken from its pipeline
+            return False
+        deadline = time.time() + PREFETCH_WAIT
+        while self._prefetch_claimed(harvest_object):
+            if time.time() > deadline:
+                log.info(
+                    'Prefetching %s takes too long, fetch it'
+                    % harvest_object.guid
+                )
+                self._release_prefetches([harvest_object.id])
+                break
+            time.sleep(PREFETCH_POLL)
+        Session.refresh(harvest_object, ['content'])
+        return bool(harvest_object.content)
+
+    def _prefetch_claimed(self, harvest_object):
+        return Session.query(HarvestObjectExtra.id).filter(
+            HarvestObjectExtra.harvest_object_id == harvest_object.id,
+            HarvestObjectExtra.key == PREFETCH_KEY
+        ).first() is not None
+
+    def _store_prefetched_record(self, harvest_object, record, e):
+        """
+        Store the content of a prefetched record with its object, a deleted
+        record withdraws its dataset like its own fetch stage would.
+        Returns whether the content has been stored.
+        """
+        if e is not None:
+            log.info(
+                'Prefetching %s failed, fetch it later: %r'
+                % (harvest_object.guid, e)
+            )
+            return False
+        try:
+            self._after_record_fetch(record)
+            header, metadata, _ = record
+            if header.isDeleted():
+                return self._fetch_deleted(harvest_object)
+            # committed together with the object being fetched
+            harvest_object.content = self._dump_content(header, metadata)
+        except Exception:
+            log.exception(
+                'Storing the prefetched record %s failed, fetch it later'
+                % harvest_object.guid
+            )
+            return False
+        return True
+
+    def _get_fetcher(self):
+        if (self._fetcher is None or
+                self._fetcher.concurrency != self.fetch_concurrency):
+            if self._fetcher is not None:
+                self._fetcher.close()
+            self._fetcher = ConcurrentFetcher(self.fetch_concurrency)
+        return self._fetcher
+
+    def _replay_record(self, harvest_object):
+        """
+        Read the record of the harvest object from the record store.
+        """
+        record = OaipmhRecord.get(
+            harvest_object.harvest_source_id,
+            harvest_object.guid
+        )
+        if record is None:
+            raise KeyError('%s is not stored' % harvest_object.guid)
+        element = etree.XML(self._get_record_store().get(record.digest))
+        metadata = self._metadata_registry.readMetadata(
+            record.metadata_prefix,
+            element
+        )
+        header = common.Header(
+            None,
+            record.guid,
+            record.datestamp,
+            json.loads(record.set_spec),
+            False
+        )
+        return header, metadata, None
+
+    def _store_record(self, header, metadata):
+        """
+        Keep the raw metadata of the record in the record store, so that
+        it can be imported again without asking the repository.
+        """
+        digest = self._get_record_store().put(
+            etree.tostring(metadata.element(), encoding='UTF-8')
+        )
+        Session.merge(OaipmhRecord(
+            harvest_source_id=self._source_id,
+            guid=header.identifier(),
+            metadata_prefix=self.md_format,
+            datestamp=header.datestamp(),
+            set_spec=json.dumps(header.setSpec()),
+            digest=digest
+        ))
+
+    def _get_record_store(self):
+        if self._record_store is None:
+            raise ValueError(
+                'Set ckanext.oaipmh.record_store to store or replay records'
+            )
+        return self._record_store
+
+    def _dump_content(self, header, metadata):
+        try:
+            metadata_modified = header.datestamp().isoformat()
+        except:
+            metadata_modified = None
+
+        if self.store_records and not self.replay:
+            self._store_record(header, metadata)
+        content_dict = metadata.getMap()
+        content_dict['set_spec'] = header.setSpec()
+        if metadata_modified:
+            content_dict['metadata_modified'] = metadata_modified
+        log.debug(content_dict)
+        return encode_content(
+            json.dumps(content_dict),
+            compress=self.compress_content
+        )
+
     def _before_record_fetch(self, harvest_object):
         pass
 
     def _after_record_fetch(self, record):
         pass
 
+    @instrument('import')
     def import_stage(self, harvest_object):
         '''
         The import stage will receive a HarvestObject object and will be
@@ -255,7 +1334,14 @@ class OaipmhHarvester(HarvesterBase):
         :param harvest_object: HarvestObject object
         :returns: True if everything went right, False if errors were found
         '''
+        try:
+            return self._import_object(harvest_object)
+        finally:
+            # whichever way the object ends, the job may be done now
+            if harvest_object and getattr(self, 'defer_indexing', False):
+                self._index_if_due(harvest_object)
 
+    def _import_object(self, harvest_object):
         log.debug("in import stage: %s" % harvest_object.guid)
         if not harvest_object:
             log.error('No harvest object received')
@@ -264,21 +1350,26 @@ class OaipmhHarvester(HarvesterBase):
 
         try:
             self._set_config(harvest_object.job.source.config)
+            job_context = self._get_job_context(harvest_object)
             context = {
                 'model': model,
                 'session': Session,
-                'user': self.user,
+                'user': job_context.user,
                 'ignore_auth': True,
             }
 
             package_dict = {}
-            content = json.loads(harvest_object.content)
+            content = json.loads(decode_content(harvest_object.content))
             log.debug(content)
+            if self._nothing_to_import(harvest_object, content):
+                return True
 
             package_dict['id'] = munge_title_to_name(harvest_object.guid)
             package_dict['name'] = package_dict['id']
+            # a record which was deleted before can reappear
+            package_dict['state'] = model.State.ACTIVE
 
-            mapping = self._get_mapping()
+            mapping = job_context.mapping
 
             for ckan_field, oai_field in mapping.iteritems():
                 try:
@@ -290,12 +1381,7 @@ class OaipmhHarvester(HarvesterBase):
             package_dict['author'] = self._extract_author(content)
 
             # add owner_org
-            source_dataset = get_action('package_show')(
-              context.copy(),
-              {'id': harvest_object.source.id}
-            )
-            owner_org = source_dataset.get('owner_org')
-            package_dict['owner_org'] = owner_org
+            package_dict['owner_org'] = job_context.owner_org
 
             # add license
             package_dict['license_id'] = self._extract_license_id(content)
@@ -337,10 +1423,7 @@ class OaipmhHarvester(HarvesterBase):
             )
 
             log.debug('Create/update package using dict: %s' % package_dict)
-            self._create_or_update_package(
-                package_dict,
-                harvest_object
-            )
+            self._save_package(package_dict, harvest_object)
 
             Session.commit()
 
@@ -357,6 +1440,302 @@ class OaipmhHarvester(HarvesterBase):
             return False
         return True
 
+    def _nothing_to_import(self, harvest_object, content):
+        """
+        Check whether the record has been deleted since the gather stage
+        or is unchanged. Remembers the fingerprint of the content. Replayed
+        records are never unchanged, they are replayed to import them with
+        a changed mapping.
+        """
+        if content.get('deleted'):
+            log.debug('%s has been deleted' % harvest_object.guid)
+            return True
+        fingerprint = self._content_fingerprint(content)
+        HarvestObjectExtra(
+            harvest_object_id=harvest_object.id,
+            key='content_hash',
+            value=fingerprint
+        ).add()
+        if self.skip_unchanged and not self.replay and \
+                self._keep_unchanged_package(harvest_object, fingerprint):
+            log.debug('%s has not changed' % harvest_object.guid)
+            metrics.count('unchanged')
+            return True
+        return False
+
+    def _save_package(self, package_dict, harvest_object):
+        """
+        Create or update the dataset. If indexing is deferred, the dataset
+        is only marked to be indexed with the next batch.
+        """
+        if not self.defer_indexing:
+            with metrics.timer('package_save'):
+                self._create_or_update_package(package_dict, harvest_object)
+            return
+        with automatic_indexing_disabled(), metrics.timer('package_save'):
+            self._create_or_update_package(package_dict, harvest_object)
+        if harvest_object.package_id:
+            mark_pending(harvest_object)
+            self._index_pending_count += 1
+
+    def _index_if_due(self, harvest_object):
+        """
+        Index the marked datasets of the source once a batch is complete
+        or no object of the job is left to fetch. While the last objects
+        of a job are imported by several consumers, each of them indexes
+        after its import, so that the marks of the last one are indexed
+        whichever consumer imports it.
+        """
+        if self._index_pending_count < self.index_batch_size:
+            remaining = Session.query(HarvestObject.id).filter(
+                HarvestObject.harvest_job_id == harvest_object.harvest_job_id,
+                HarvestObject.state.in_([u'WAITING', u'FETCH'])
+            ).count()
+            if remaining:
+                return
+        try:
+            with metrics.timer('index'):
+                index_pending(harvest_object.harvest_source_id)
+            self._index_pending_count = 0
+        except Exception:
+            log.exception(
+                'Indexing the datasets of %s failed, retry with the next batch'
+                % harvest_object.source.url
+            )
+
+    def _create_or_update_package(self, package_dict, harvest_object):
+        """
+        Create or update the dataset straight away, as the job context
+        knows which datasets of the source exist, instead of showing the
+        dataset first. Datasets which are not active, or which exist
+        without the job context knowing them, are left to HarvesterBase.
+        """
+        job_context = self._get_job_context(harvest_object)
+        package_id, name, state = job_context.packages.get(
+            harvest_object.guid,
+            (None, None, None)
+        )
+        if package_id is None and not self._package_exists(
+                job_context, harvest_object.guid, package_dict):
+            return self._create_package(
+                job_context, package_dict, harvest_object
+            )
+        if state == model.State.ACTIVE:
+            return self._update_package(
+                job_context, package_id, name, package_dict, harvest_object
+            )
+        return HarvesterBase._create_or_update_package(
+            self, package_dict, harvest_object
+        )
+
+    def _package_exists(self, job_context, guid, package_dict):
+        """
+        Whether a dataset which the source does not know has the id of the
+        guid. Guids gathered after the job context has been resolved are
+        looked up one by one.
+        """
+        taken = job_context.ids_taken.get(guid)
+        if taken is None:
+            taken = Session.query(model.Package.id).filter(
+                model.Package.id == package_dict['id']
+            ).first() is not None
+        return taken
+
+    def _package_context(self, job_context):
+        """
+        The context HarvesterBase creates and updates datasets with.
+        """
+        schema = default_create_package_schema()
+        schema['id'] = [ignore_missing, unicode]
+        schema['__junk'] = [ignore]
+        return {
+            'model': model,
+            'session': Session,
+            'user': job_context.user,
+            'api_version': 2,
+            'schema': schema,
+            'ignore_auth': True,
+        }
+
+    def _create_package(self, job_context, package_dict, harvest_object):
+        """
+        Create the dataset like HarvesterBase does once it has not found
+        it, with a name which is not taken yet.
+        """
+        context = self._package_context(job_context)
+        context.pop('__auth_audit', None)
+        package_dict['name'] = self._gen_new_name(
+            package_dict.get('name') or package_dict['title']
+        )
+        harvest_object.current = True
+        harvest_object.package_id = package_dict['id']
+        harvest_object.add()
+        # the dataset is indexed with the id of its harvest object
+        Session.execute(
+            'SET CONSTRAINTS harvest_object_package_id_fkey DEFERRED'
+        )
+        Session.flush()
+        try:
+            get_action('package_create_rest')(context, package_dict)
+        except ValidationError, e:
+            return self._save_package_error(e, harvest_object)
+        job_context.packages[harvest_object.guid] = (
+            package_dict['id'],
+            package_dict['name'],
+            model.State.ACTIVE
+        )
+        Session.commit()
+        return True
+
+    def _update_package(self, job_context, package_id, name, package_dict,
+                        harvest_object):
+        context = self._package_context(job_context)
+        context['id'] = package_id
+        # like HarvesterBase, keep the name the dataset has been created with
+        package_dict['name'] = name
+        try:
+            get_action('package_update_rest')(context, package_dict)
+        except NotFound:
+            del job_context.packages[harvest_object.guid]
+            return HarvesterBase._create_or_update_package(
+                self, package_dict, harvest_object
+            )
+        except ValidationError, e:
+            return self._save_package_error(e, harvest_object)
+        # the other objects of the dataset are not current anymore
+        Session.execute(
+            harvest_object_table.update()
+            .where(harvest_object_table.c.package_id == package_id)
+            .values(current=False)
+        )
+        harvest_object.package_id = package_id
+        harvest_object.current = True
+        harvest_object.save()
+        return True
+
+    def _save_package_error(self, e, harvest_object):
+        # reported like HarvesterBase does
+        log.exception(e)
+        self._save_object_error(
+            'Invalid package with GUID %s: %r'
+            % (harvest_object.guid, e.error_dict),
+            harvest_object,
+            'Import'
+        )
+        return None
+
+    def _content_fingerprint(self, content):
+        return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+    def _keep_unchanged_package(self, harvest_object, fingerprint):
+        """
+        If the current object of the same guid has been imported from the
+        same content and its dataset is still active, make the harvest
+        object current instead of updating the dataset. Returns whether
+        the dataset was kept.
+        """
+        if harvest_object.guid not in \
+                self._get_job_context(harvest_object).packages:
+            # no dataset has been imported for the guid yet
+            return False
+        previous_object = Session.query(HarvestObject).join(
+            HarvestObjectExtra,
+            HarvestObjectExtra.harvest_object_id == HarvestObject.id
+        ).filter(
+            HarvestObject.guid == harvest_object.guid,
+            HarvestObject.harvest_source_id ==
+            harvest_object.harvest_source_id,
+            HarvestObject.current == True,  # noqa
+            HarvestObject.id != harvest_object.id,
+            HarvestObjectExtra.key == 'content_hash',
+            HarvestObjectExtra.value == fingerprint
+        ).first()
+        if previous_object is None or previous_object.package is None or \
+                previous_object.package.state != model.State.ACTIVE:
+            return False
+
+        previous_object.current = False
+        harvest_object.current = True
+        harvest_object.package_id = previous_object.package_id
+        Session.commit()
+        return True
+
+    def _get_job_context(self, harvest_object):
+        """
+        Return the context of the job of the harvest object, it is resolved
+        again for every new job and whenever the source config changes.
+        """
+        if (self._job_context is None or
+                not self._job_context.matches(harvest_object)):
+            context = {
+                'model': model,
+                'session': Session,
+                'user': self.user,
+                'ignore_auth': True,
+            }
+            source_dataset = get_action('package_show')(
+                context,
+                {'id': harvest_object.source.id}
+            )
+            packages = self._get_packages(harvest_object.harvest_source_id)
+            self._job_context = JobContext(
+                harvest_object.harvest_job_id,
+                harvest_object.source.config,
+                self.user,
+                source_dataset.get('owner_org'),
+                self._get_mapping(),
+                packages,
+                self._get_ids_taken(harvest_object.harvest_job_id, packages)
+            )
+        return self._job_context
+
+    def _get_packages(self, harvest_source_id):
+        """
+        Return the id, name and state of the dataset of every guid of the
+        source, from its current harvest objects, with a single query.
+        """
+        rows = Session.query(
+            HarvestObject.guid,
+            model.Package.id,
+            model.Package.name,
+            model.Package.state
+        ).join(
+            model.Package,
+            model.Package.id == HarvestObject.package_id
+        ).filter(
+            HarvestObject.harvest_source_id == harvest_source_id,
+            HarvestObject.current == True  # noqa
+        )
+        return dict((guid, (package_id, name, state))
+                    for guid, package_id, name, state in rows)
+
+    def _get_ids_taken(self, harvest_job_id, packages):
+        """
+        Return whether a dataset has the id of each guid of the job which
+        has no dataset of the source yet, e.g. a dataset harvested by
+        another source, with a query per PACKAGE_ID_BATCH_SIZE guids.
+        """
+        guids = Session.query(HarvestObject.guid).filter(
+            HarvestObject.harvest_job_id == harvest_job_id
+        ).distinct()
+        # not memoized, the guids of a job are munged only once
+        ids = dict(
+            (munge_title_to_name(guid), guid)
+            for guid, in guids if guid not in packages
+        )
+        package_ids = ids.keys()
+        taken = set()
+        for i in range(0, len(package_ids), PACKAGE_ID_BATCH_SIZE):
+            rows = Session.query(model.Package.id).filter(
+                model.Package.id.in_(
+                    package_ids[i:i + PACKAGE_ID_BATCH_SIZE]
+                )
+            )
+            taken.update(package_id for package_id, in rows)
+        return dict(
+            (guid, package_id in taken) for package_id, guid in ids.items()
+        )
+
     def _get_mapping(self):
         return {
             'title': 'title',
@@ -373,36 +1752,18 @@ class OaipmhHarvester(HarvesterBase):
         return ', '.join(content['rights'])
 
     def _extract_tags_and_extras(self, content):
-        extras = []
-        tags = []
-        for key, value in content.iteritems():
-            if key in self._get_mapping().values():
-                continue
-            if key in ['type', 'subject']:
-                if type(value) is list:
-                    tags.extend(value)
-                else:
-                    tags.extend(value.split(';'))
-                continue
-            if value and type(value) is list:
-                value = value[0]
-            if not value:
-                value = None
-            if key.endswith('date') and value:
-                # the ckan indexer can't handle timezone-aware datetime objects
-                try:
-                    from dateutil.parser import parse
-                    date_value = parse(value)
-                    date_without_tz = date_value.replace(tzinfo=None)
-                    value = date_without_tz.isoformat()
-                except (ValueError, TypeError):
-                    continue
-
-            extras.append((key, value))
+        return self._get_transform().tags_and_extras(content)
 
-        tags = [munge_tag(tag[:100]) for tag in tags]
-
-        return (tags, extras)
+    def _get_transform(self):
+        """
+        Return the transform of the content for the field mapping, it is
+        only built again if the mapping changes.
+        """
+        mapped_fields = frozenset(self._get_mapping().values())
+        if (self._transform is None or
+                self._transform.mapped_fields != mapped_fields):
+            self._transform = FieldTransform(mapped_fields, _munge_tag)
+        return self._transform
 
     def _get_possible_resource(self, harvest_obj, content):
         url = None
@@ -447,18 +1808,36 @@ class OaipmhHarvester(HarvesterBase):
         log.debug('Group names: %s' % groups)
         group_ids = []
         for group_name in groups:
-            data_dict = {
-                'id': group_name,
-                'name': munge_title_to_name(group_name),
-                'title': group_name
-            }
-            try:
-                group = get_action('group_show')(context.copy(), data_dict)
-                log.info('found the group ' + group['id'])
-            except:
-                group = get_action('group_create')(context.copy(), data_dict)
-                log.info('created the group ' + group['id'])
-            group_ids.append(group['id'])
+            group_id = self._group_ids.get(group_name)
+            if group_id is None:
+                with metrics.timer('group_lookup'):
+                    group_id = self._find_or_create_group(group_name, context)
+                self._group_ids.set(group_name, group_id)
+            else:
+                metrics.count('group_cache_hits')
+            group_ids.append(group_id)
 
         log.debug('Group ids: %s' % group_ids)
         return group_ids
+
+    def _find_or_create_group(self, group_name, context):
+        data_dict = {
+            'id': group_name,
+            'name': _munge_name(group_name),
+            'title': group_name
+        }
+        try:
+            group = get_action('group_show')(context.copy(), data_dict)
+            log.info('found the group ' + group['id'])
+        except:
+            try:
+                group = get_action('group_create')(context.copy(), data_dict)
+                log.info('created the group ' + group['id'])
+            except ValidationError:
+                # another import worker has created the group meanwhile
+                group = get_action('group_show')(
+                    context.copy(),
+                    {'id': data_dict['name']}
+                )
+                log.info('found the group ' + group['id'])
+        return group['id']
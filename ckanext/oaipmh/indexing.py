@@ -0,0 +1,81 @@
+'''
+Deferred search indexing of harvested datasets: instead of indexing every
+dataset as soon as it is saved, the datasets are marked and indexed in
+batches with a single commit of the search index.
+'''
+import logging
+from contextlib import contextmanager
+
+from ckan import plugins
+from ckan.model import Session
+from ckan.lib import search
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra
+
+log = logging.getLogger(__name__)
+
+PENDING_KEY = 'index_pending'
+
+
+@contextmanager
+def automatic_indexing_disabled():
+    '''
+    Do not index the datasets saved within this block. CKAN only reads
+    ckan.search.automatic_indexing when it loads the plugins, so the
+    plugin which indexes the saved datasets is disabled instead.
+    '''
+    if not plugins.plugin_loaded('synchronous_search'):
+        yield
+        return
+    plugin = search.SynchronousSearchPlugin()
+    plugin.disable()
+    try:
+        yield
+    finally:
+        plugin.enable()
+
+
+def mark_pending(harvest_object):
+    '''
+    Remember that the dataset of the harvest object has to be indexed.
+    The mark is stored with the object, so that it survives a crash of
+    the consumer before the next batch is indexed.
+    '''
+    HarvestObjectExtra(
+        harvest_object_id=harvest_object.id,
+        key=PENDING_KEY,
+        value=harvest_object.package_id
+    ).add()
+
+
+def index_pending(harvest_source_id):
+    '''
+    Index the datasets of all marked objects of a source and commit the
+    search index once. The marks of datasets which could not be indexed
+    are kept for the next batch. Returns the number of indexed datasets.
+    '''
+    marks = Session.query(HarvestObjectExtra).join(
+        HarvestObject,
+        HarvestObjectExtra.harvest_object_id == HarvestObject.id
+    ).filter(
+        HarvestObject.harvest_source_id == harvest_source_id,
+        HarvestObjectExtra.key == PENDING_KEY
+    ).all()
+    if not marks:
+        return 0
+
+    indexed = set()
+    for package_id in set(mark.value for mark in marks):
+        try:
+            search.rebuild(package_id, defer_commit=True)
+            indexed.add(package_id)
+        except Exception:
+            log.exception('Indexing dataset %s failed' % package_id)
+    search.commit()
+
+    for mark in marks:
+        if mark.value in indexed:
+            mark.delete()
+    Session.commit()
+    log.info('%s datasets indexed' % len(indexed))
+    return len(indexed)
@@ -0,0 +1,28 @@
+class JobContext(object):
+    '''
+    Source-level data which is the same for every object of a harvest job,
+    so that the import stage resolves it only once per job: the user to
+    import as, the organization of the source, the field mapping and the
+    id, name and state of the dataset of every guid of the source. The datasets
+    created by the job are added to the latter. For the other guids of the
+    job, `ids_taken` tells whether a dataset has their id already.
+
+    A context is only valid for the job and the source configuration it
+    has been resolved with.
+    '''
+
+    def __init__(self, job_id, source_config, user, owner_org, mapping,
+                 packages, ids_taken):
+        self.job_id = job_id
+        self.source_config = source_config
+        self.user = user
+        self.owner_org = owner_org
+        self.mapping = mapping
+        self.packages = packages
+        self.ids_taken = ids_taken
+
+    def matches(self, harvest_object):
+        return (
+            self.job_id == harvest_object.harvest_job_id and
+            self.source_config == harvest_object.source.config
+        )
@@ -0,0 +1,66 @@
+'''
+Page-wise OAI-PMH list requests. The generators of pyoai hide the
+resumption tokens, which are needed to continue an interrupted listing.
+'''
+import time
+
+from oaipmh import error
+from oaipmh.datestamp import datetime_to_datestamp
+
+
+def list_pages(client, verb, args, resumption_token=None, observe=None):
+    '''
+    Yield a (items, resumption_token) tuple for every page of a
+    ListIdentifiers or ListRecords request, where the items are headers
+    respectively (header, metadata, about) tuples. The token of the last
+    page is None.
+
+    If a resumption token is given, the listing continues with the page
+    it refers to, `args` is still needed to read the records then. If no
+    records match the arguments nothing is yielded. `observe` is called
+    with the verb, the number of items and the seconds it took to request
+    and read every page.
+    '''
+    if resumption_token is None:
+        kw = _request_args(client, args)
+    else:
+        kw = {'resumptionToken': resumption_token}
+    while True:
+        start = time.time()
+        try:
+            tree = client.makeRequestErrorHandling(verb=verb, **kw)
+        except error.NoRecordsMatchError:
+            return
+        if verb == 'ListRecords':
+            items, token = client.buildRecords(
+                args['metadataPrefix'],
+                client.getNamespaces(),
+                client.getMetadataRegistry(),
+                tree
+            )
+        else:
+            items, token = client.buildIdentifiers(
+                client.getNamespaces(),
+                tree
+            )
+        if observe is not None:
+            observe(verb, len(items), time.time() - start)
+        yield items, token
+        if token is None:
+            return
+        kw = {'resumptionToken': token}
+
+
+def _request_args(client, args):
+    '''
+    Turn the arguments of a list method of pyoai into request parameters,
+    the way pyoai does it itself in BaseClient.handleVerb.
+    '''
+    kw = dict(args)
+    from_ = kw.pop('from_', None)
+    if from_ is not None:
+        kw['from'] = datetime_to_datestamp(from_, client._day_granularity)
+    until = kw.pop('until', None)
+    if until is not None:
+        kw['until'] = datetime_to_datestamp(until, client._day_granularity)
+    return kw
@@ -1,6 +1,237 @@
+import re
+from io import BytesIO
+
+from lxml import etree
+from oaipmh import common
+from oaipmh.metadata import Error
 from oaipmh.metadata import MetadataReader
 
-oai_ddi_reader = MetadataReader(
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+OAI_METADATA = '{http://www.openarchives.org/OAI/2.0/}metadata'
+
+_step = r'(?:(\w+):)?([\w.-]+)'
+_path_re = re.compile(
+    r'^(%s(?:/%s)*)/(?:(text\(\))|@%s)$' % (_step, _step, _step)
+)
+_step_re = re.compile(_step)
+
+
+class CompiledMetadataReader(MetadataReader):
+    '''
+    A MetadataReader which reads all fields in a single pass over the
+    record instead of evaluating one XPath expression per field.
+
+    Fields of type textList with a plain child path ending in text() or
+    an attribute, like 'oai_dc:dc/dc:title/text()', are collected by
+    walking the element tree once. All other fields are read with XPath
+    expressions which are compiled once. The result is the same as the
+    one of MetadataReader.
+    '''
+
+    def __init__(self, fields, namespaces=None):
+        MetadataReader.__init__(self, fields, namespaces)
+        self._tree = _PathNode()
+        self._xpath_fields = {}
+        for field_name, (field_type, expr) in fields.items():
+            steps = None
+            if field_type == 'textList':
+                steps = self._parse_path(expr)
+            if steps is None:
+                self._xpath_fields[field_name] = (
+                    field_type,
+                    etree.XPath(expr, namespaces=self._namespaces)
+                )
+            else:
+                self._tree.add(steps, field_name)
+        self._tree_fields = self._tree.fields()
+
+    def __call__(self, element):
+        map = dict((field_name, []) for field_name in self._tree_fields)
+        self._tree.collect(element, map)
+        for field_name, (field_type, xpath) in self._xpath_fields.items():
+            map[field_name] = _convert(field_type, xpath(element))
+        return common.Metadata(element, map)
+
+    def _parse_path(self, expr):
+        '''
+        Return the qualified names of the elements of a plain child path
+        and the name of the attribute it ends in, or None if the path is
+        not a plain child path.
+        '''
+        match = _path_re.match(expr)
+        if match is None:
+            return None
+        try:
+            tags = [
+                self._qualify(prefix, name)
+                for prefix, name in _step_re.findall(match.group(1))
+            ]
+            attribute = None
+            if not match.group(6):
+                attribute = self._qualify(match.group(7), match.group(8))
+        except KeyError:
+            # leave the error about an unknown prefix to XPath
+            return None
+        return tags, attribute
+
+    def _qualify(self, prefix, name):
+        if not prefix:
+            return name
+        if prefix == 'xml':
+            return '{%s}%s' % (XML_NAMESPACE, name)
+        return '{%s}%s' % (self._namespaces[prefix], name)
+
+
+class _PathNode(object):
+    '''
+    A node of the tree of element paths read by a CompiledMetadataReader.
+    '''
+
+    def __init__(self):
+        self.children = {}
+        self.tags = ()
+        self.text_fields = []
+        self.attribute_fields = []
+
+    def add(self, steps, field_name):
+        tags, attribute = steps
+        node = self
+        for tag in tags:
+            if tag not in node.children:
+                node.children[tag] = _PathNode()
+                node.tags = tuple(node.children)
+            node = node.children[tag]
+        if attribute is None:
+            node.text_fields.append(field_name)
+        else:
+            node.attribute_fields.append((attribute, field_name))
+
+    def fields(self):
+        fields = list(self.text_fields)
+        fields.extend(field_name for _, field_name in self.attribute_fields)
+        for child in self.children.values():
+            fields.extend(child.fields())
+        return fields
+
+    def collect(self, element, map):
+        '''
+        Add the values of the fields of this node and its children to the
+        map, in document order like XPath.
+        '''
+        for field_name in self.text_fields:
+            map[field_name].extend(_text_nodes(element))
+        for attribute, field_name in self.attribute_fields:
+            value = element.get(attribute)
+            if value is not None:
+                map[field_name].append(unicode(value))
+        if not self.tags:
+            return
+        # let lxml filter the children by tag, so that no proxy objects
+        # are created for the elements which are not read
+        children = self.children
+        for child in element.iterchildren(*self.tags):
+            children[child.tag].collect(child, map)
+
+
+# parse states of the elements which are not below the metadata read by
+# a PruningParser and of the elements which are dropped
+_KEEP = object()
+_PRUNE = object()
+
+
+class PruningParser(object):
+    '''
+    Parses OAI-PMH responses like etree.XML, but drops the elements of the
+    record metadata which the reader does not read while the response is
+    parsed. Every dropped element is freed as soon as it has been parsed,
+    so a record needs only memory for the elements which are read, however
+    large the rest of it is.
+
+    Only metadata with the root element of the reader is pruned, other
+    metadata and the rest of the response are parsed as is. The reader
+    has to be a CompiledMetadataReader which reads all fields in a single
+    pass, otherwise nothing is pruned.
+    '''
+
+    def __init__(self, reader):
+        self._tree = None
+        if not reader._xpath_fields:
+            self._tree = reader._tree
+
+    def __call__(self, xml):
+        if self._tree is None:
+            return etree.XML(xml)
+        states = []
+        events = etree.iterparse(BytesIO(xml), events=('start', 'end'))
+        for event, element in events:
+            if event == 'start':
+                states.append(self._state(element, states))
+                continue
+            state = states.pop()
+            if state is _PRUNE:
+                _drop(element, states[-1])
+        return events.root
+
+    def _state(self, element, states):
+        if not states:
+            return _KEEP
+        parent = states[-1]
+        if parent is _KEEP:
+            return self._tree if element.tag == OAI_METADATA else _KEEP
+        if parent is _PRUNE:
+            return _PRUNE
+        node = parent.children.get(element.tag)
+        if node is not None:
+            return node
+        if parent is self._tree:
+            # metadata which is not read by the reader
+            return _KEEP
+        return _PRUNE
+
+
+def _drop(element, parent_state):
+    '''
+    Free a parsed element which is not read. It is kept as an empty
+    element if its tail is a text node read from the parent.
+    '''
+    if parent_state is not _PRUNE and parent_state.text_fields:
+        tail = element.tail
+        element.clear()
+        element.tail = tail
+    else:
+        element.getparent().remove(element)
+
+
+def _text_nodes(element):
+    '''
+    Return the text nodes which are children of the element, like the
+    XPath expression text() does.
+    '''
+    texts = []
+    if element.text is not None:
+        texts.append(unicode(element.text))
+    for child in element:
+        if child.tail is not None:
+            texts.append(unicode(child.tail))
+    return texts
+
+
+def _convert(field_type, value):
+    '''
+    Convert the result of an XPath expression like MetadataReader does.
+    '''
+    if field_type == 'bytes':
+        return str(value)
+    elif field_type == 'bytesList':
+        return [str(item) for item in value]
+    elif field_type == 'text':
+        return unicode(value)
+    elif field_type == 'textList':
+        return [unicode(v) for v in value]
+    raise Error('Unknown field type: %s' % field_type)
+
+
+oai_ddi_reader = CompiledMetadataReader(
     fields={
         'title':        ('textList', 'oai_ddi:codeBook/stdyDscr/citation/titlStmt/titl/text()'),  # noqa
         'creator':      ('textList', 'oai_ddi:codeBook/stdyDscr/citation/rspStmt/AuthEnty/text()'),  # noqa
@@ -24,8 +255,11 @@ oai_ddi_reader = MetadataReader(
     }
 )
 
+# DDI codebooks can have huge data descriptions, which are not read
+ddi_parser = PruningParser(oai_ddi_reader)
+
 # Note: maintainer_email is not part of Dublin Core
-oai_dc_reader = MetadataReader(
+oai_dc_reader = CompiledMetadataReader(
     fields={
         'title':            ('textList', 'oai_dc:dc/dc:title/text()'),  # noqa
         'creator':          ('textList', 'oai_dc:dc/dc:creator/text()'),  # noqa
@@ -0,0 +1,202 @@
+'''
+Counters and timings of the harvester. The values are collected per
+process for the whole lifetime of a gather, fetch or import consumer, and
+per harvest job. The process values can be written to a file per process
+in the text format of Prometheus, e.g. for the textfile collector of
+node_exporter. The job values are added up in the oaipmh_job_metric table
+by all consumers which work on the job.
+'''
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+log = logging.getLogger(__name__)
+
+# seconds between two writes of the process values to the file
+FLUSH_INTERVAL = 30
+PREFIX = 'oaipmh_'
+
+
+class Metrics(object):
+    '''
+    Thread-safe counters and timers. Every value has a name and labels,
+    counters add up a value and timers count the observed durations and
+    add them up.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._job_id = None
+        self._job_values = {}
+        self._written = time.time()
+        # file to write the process values to, the id of the process is
+        # added to its name
+        self.path = None
+
+    def count(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._add_job_value(key, 0, value)
+
+    def observe(self, name, seconds, **labels):
+        key = (name + '_seconds', _labels(labels))
+        with self._lock:
+            count, total = self._timers.get(key, (0, 0.0))
+            self._timers[key] = (count + 1, total + seconds)
+            self._add_job_value(key, 1, seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''
+        Observe the duration of the with block.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def start_job(self, harvest_job_id):
+        '''
+        Attribute the following values to the given job, until another
+        job is started. The values of the previous job are saved first.
+        '''
+        if harvest_job_id != self._job_id:
+            self.flush(force=True)
+            self._job_id = harvest_job_id
+
+    def flush(self, force=False):
+        '''
+        Save the values of the current job which have not been saved yet,
+        so that the values of a job are complete as soon as its last
+        object is done. The process values are written to the file if the
+        last write is FLUSH_INTERVAL seconds ago or `force` is set. Saving
+        metrics never fails a harvest, errors are only logged.
+        '''
+        with self._lock:
+            job_id, values = self._job_id, self._job_values
+            self._job_values = {}
+            write = self.path and (
+                force or time.time() - self._written >= FLUSH_INTERVAL
+            )
+            if write:
+                self._written = time.time()
+        try:
+            if job_id is not None and values:
+                # imported here, so that the client can be used without CKAN
+                from model import save_job_metrics
+                save_job_metrics(job_id, values)
+            if write:
+                self.write(self.process_path(), pid=os.getpid())
+        except Exception:
+            log.exception('Saving the metrics of job %s failed' % job_id)
+
+    def process_path(self):
+        '''
+        Return the file of this process, e.g. oaipmh_fetch.1234.prom for
+        oaipmh_fetch.prom, as all consumers read the same configuration.
+        '''
+        root, ext = os.path.splitext(self.path)
+        return '%s.%s%s' % (root, os.getpid(), ext)
+
+    def write(self, path, **labels):
+        '''
+        Write the process values to the file in the Prometheus text
+        format, replacing it atomically. The labels are added to every
+        value.
+        '''
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus(**labels))
+        os.rename(tmp_path, path)
+
+    def prometheus(self, **labels):
+        '''
+        Return the process values in the Prometheus text format, with the
+        labels added to every value.
+        '''
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted(self._timers.items())
+        extra = _labels(labels)
+        lines = []
+        for (name, value_labels), value in counters:
+            lines.append(
+                _sample(name + '_total', value_labels + extra, value)
+            )
+        for (name, value_labels), (count, total) in timers:
+            lines.append(
+                _sample(name + '_count', value_labels + extra, count)
+            )
+            lines.append(_sample(name + '_sum', value_labels + extra, total))
+        return ''.join(line + '\n' for line in lines)
+
+    def _add_job_value(self, key, count, total):
+        if self._job_id is None:
+            return
+        job_count, job_total = self._job_values.get(key, (0, 0))
+        self._job_values[key] = (job_count + count, job_total + total)
+
+
+def instrument(stage):
+    '''
+    Decorate a stage method of the harvester, which is called with a
+    harvest job in the gather stage and with a harvest object otherwise,
+    to time it and count the objects it handles.
+    '''
+    def decorate(method):
+        @wraps(method)
+        def wrapper(harvester, obj):
+            if stage == 'gather':
+                metrics.start_job(obj.id)
+            else:
+                metrics.start_job(obj.harvest_job_id)
+            result = None
+            try:
+                with metrics.timer('stage', stage=stage):
+                    result = method(harvester, obj)
+            finally:
+                if result is None or result is False:
+                    metrics.count('failures', stage=stage)
+                else:
+                    metrics.count(
+                        'objects',
+                        len(result) if stage == 'gather' else 1,
+                        stage=stage
+                    )
+                metrics.flush(force=(stage == 'gather'))
+            return result
+        return wrapper
+    return decorate
+
+
+def _labels(labels):
+    return tuple(sorted(
+        (key, value) for key, value in labels.items() if value is not None
+    ))
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join(
+            '%s="%s"' % (key, str(value).replace('"', '\\"'))
+            for key, value in labels
+        )
+    return '%s%s %s' % (PREFIX, name, value)
+
+
+def format_labels(labels):
+    '''
+    Return the labels of a value as stored in the database.
+    '''
+    return ','.join('%s=%s' % label for label in labels)
+
+
+# the metrics of this process
+metrics = Metrics()
@@ -0,0 +1,376 @@
+import logging
+import datetime
+
+from sqlalchemy import Table
+from sqlalchemy import Column
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import types
+from sqlalchemy.exc import IntegrityError
+
+from ckan.model import meta
+from ckan.model.meta import metadata, mapper, Session
+from ckan.model.domain_object import DomainObject
+from ckan.model.types import make_uuid
+
+from metrics import format_labels
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    'OaipmhCheckpoint', 'oaipmh_checkpoint_table',
+    'OaipmhPartition', 'oaipmh_partition_table',
+    'oaipmh_gathered_table', 'claim_guids', 'forget_guids',
+    'oaipmh_job_metric_table', 'save_job_metrics', 'job_metrics',
+    'OaipmhRecord', 'oaipmh_record_table',
+    'OaipmhReplay', 'oaipmh_replay_table',
+    'OaipmhCapability', 'oaipmh_capability_table',
+]
+
+
+def setup():
+    '''
+    Create the tables of the OAI-PMH harvester if they do not exist yet.
+    '''
+    for table in metadata.sorted_tables:
+        if table.name.startswith('oaipmh_') and not table.exists():
+            table.create()
+            log.debug('Table %s created' % table.name)
+
+
+class OaipmhCheckpoint(DomainObject):
+    '''
+    The resumption token of the last page a harvest source was listed up
+    to, so that a failed gather can be continued by the next job instead
+    of starting all over again. `args` are the listing arguments the token
+    belongs to, stored as JSON. `objects_queued` tells whether the objects
+    gathered so far have been sent to the fetch queue already.
+    '''
+
+    @classmethod
+    def get(cls, harvest_source_id):
+        return Session.query(cls).get(harvest_source_id)
+
+
+class OaipmhPartition(DomainObject):
+    '''
+    A part of the listing of a harvest job which is gathered on its own,
+    possibly by another gather consumer. The listing arguments of the
+    partition are stored as JSON. `created` is the start of the gather
+    which split the listing, i.e. the start of the job, and `updated` is
+    refreshed with every batch the partition saves.
+    '''
+
+    @classmethod
+    def for_job(cls, harvest_job_id):
+        return Session.query(cls).filter(
+            cls.harvest_job_id == harvest_job_id
+        ).all()
+
+    @classmethod
+    def claim(cls, harvest_job_id, lease):
+        '''
+        Return a new partition of the job after marking it as running, or
+        None if there is none left. A running partition which has not been
+        updated for `lease` seconds is claimed again, as its consumer has
+        probably died. The update only succeeds for one of the consumers
+        claiming the same partition at the same time.
+        '''
+        now = datetime.datetime.utcnow()
+        expired = now - datetime.timedelta(seconds=lease)
+        candidates = Session.query(cls.id, cls.state, cls.updated).filter(
+            cls.harvest_job_id == harvest_job_id,
+            or_(
+                cls.state == u'NEW',
+                and_(cls.state == u'RUNNING', cls.updated < expired)
+            )
+        ).all()
+        for candidate in candidates:
+            if candidate.state == u'RUNNING':
+                log.info('Partition %s has expired, claim it again'
+                         % candidate.id)
+            result = Session.execute(
+                oaipmh_partition_table.update()
+                .where(oaipmh_partition_table.c.id == candidate.id)
+                .where(oaipmh_partition_table.c.state == candidate.state)
+                .where(oaipmh_partition_table.c.updated == candidate.updated)
+                .values(state=u'RUNNING', updated=now)
+            )
+            Session.commit()
+            if result.rowcount == 1:
+                return Session.query(cls).get(candidate.id)
+        return None
+
+    @classmethod
+    def unfinished_jobs(cls):
+        '''
+        Return the ids of the jobs which have partitions left to gather.
+        '''
+        return [
+            harvest_job_id for harvest_job_id, in
+            Session.query(cls.harvest_job_id).filter(
+                cls.state.in_([u'NEW', u'RUNNING'])
+            ).distinct()
+        ]
+
+    @classmethod
+    def left(cls, harvest_job_id):
+        '''
+        Return the number of partitions of the job which are left to
+        gather.
+        '''
+        return Session.query(cls).filter(
+            cls.harvest_job_id == harvest_job_id,
+            cls.state.in_([u'NEW', u'RUNNING'])
+        ).count()
+
+    @classmethod
+    def stalled(cls, harvest_job_id, lease):
+        '''
+        Return whether a partition of the job which is left to gather has
+        not been updated for `lease` seconds, i.e. its consumer has
+        probably died or its gather message has been lost.
+        '''
+        expired = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=lease)
+        return Session.query(cls).filter(
+            cls.harvest_job_id == harvest_job_id,
+            cls.state.in_([u'NEW', u'RUNNING']),
+            cls.updated < expired
+        ).count() > 0
+
+    @classmethod
+    def job_started(cls, harvest_job_id):
+        '''
+        Return the start of a job whose listing has been partitioned, or
+        None if it has not been.
+        '''
+        return Session.query(func.min(cls.created)).filter(
+            cls.harvest_job_id == harvest_job_id
+        ).scalar()
+
+
+class OaipmhRecord(DomainObject):
+    '''
+    The last stored raw XML of a harvested record, by the digest of its
+    metadata element in the record store, with the header of the record.
+    The set specs are stored as JSON.
+    '''
+
+    @classmethod
+    def get(cls, harvest_source_id, guid):
+        return Session.query(cls).get((harvest_source_id, guid))
+
+
+class OaipmhReplay(DomainObject):
+    '''
+    Marks a harvest job which has imported the stored records instead of
+    harvesting the repository.
+    '''
+
+
+class OaipmhCapability(DomainObject):
+    '''
+    The capabilities of the repository of a harvest source, as probed at
+    `probed` from `url` and serialized by Capabilities.dump.
+    '''
+
+    @classmethod
+    def get(cls, harvest_source_id):
+        return Session.query(cls).get(harvest_source_id)
+
+
+def claim_guids(harvest_source_id, harvest_job_id, guids):
+    '''
+    Record the identifiers as gathered by the job and return the ones it
+    had not gathered yet, in their order. Of several consumers which list
+    the same identifier at the same time, only one claims it: the insert
+    of the others waits for the first one to commit and fails, and they
+    try again without the identifiers claimed by then. The caller has to
+    commit.
+    '''
+    table = oaipmh_gathered_table
+    while True:
+        claimed = set(guid for guid, in Session.execute(
+            select([table.c.guid]).where(and_(
+                table.c.harvest_job_id == harvest_job_id,
+                table.c.guid.in_(guids)
+            ))
+        )) if guids else set()
+        new_guids = [guid for guid in guids if guid not in claimed]
+        if not new_guids:
+            return []
+        Session.begin_nested()
+        try:
+            # in the same order by all consumers, so that they do not
+            # deadlock on each other's identifiers
+            Session.execute(table.insert(), [
+                {
+                    'harvest_job_id': harvest_job_id,
+                    'guid': guid,
+                    'harvest_source_id': harvest_source_id,
+                }
+                for guid in sorted(new_guids)
+            ])
+        except IntegrityError:
+            Session.rollback()
+            log.debug('Identifiers of job %s claimed by another consumer, '
+                      'try again' % harvest_job_id)
+            continue
+        # releases the savepoint
+        Session.commit()
+        return new_guids
+
+
+def forget_guids(harvest_source_id, except_job_id=None):
+    '''
+    Forget the identifiers gathered by the jobs of the source, but the
+    ones of `except_job_id`. The caller has to commit.
+    '''
+    table = oaipmh_gathered_table
+    query = table.delete().where(
+        table.c.harvest_source_id == harvest_source_id
+    )
+    if except_job_id is not None:
+        query = query.where(table.c.harvest_job_id != except_job_id)
+    Session.execute(query)
+
+
+def save_job_metrics(harvest_job_id, values):
+    '''
+    Add the (observations, value) tuples of a job, keyed by metric name
+    and labels, to the ones saved before. The values are saved in a
+    transaction of their own, outside of the session of the harvester.
+    '''
+    table = oaipmh_job_metric_table
+    with meta.engine.begin() as connection:
+        for (name, labels), (observations, value) in values.items():
+            labels = format_labels(labels)
+            result = connection.execute(
+                table.update().where(and_(
+                    table.c.harvest_job_id == harvest_job_id,
+                    table.c.name == name,
+                    table.c.labels == labels
+                )).values(
+                    observations=table.c.observations + observations,
+                    value=table.c.value + value
+                )
+            )
+            if result.rowcount == 0:
+                connection.execute(table.insert().values(
+                    harvest_job_id=harvest_job_id,
+                    name=name,
+                    labels=labels,
+                    observations=observations,
+                    value=value
+                ))
+
+
+def job_metrics(harvest_job_id):
+    '''
+    Return the metrics of a job as a list of (name, labels, observations,
+    value) tuples. Timers have a number of observations, counters do not.
+    '''
+    table = oaipmh_job_metric_table
+    return [
+        tuple(row) for row in Session.execute(
+            table.select()
+            .with_only_columns([
+                table.c.name, table.c.labels,
+                table.c.observations, table.c.value
+            ])
+            .where(table.c.harvest_job_id == harvest_job_id)
+            .order_by(table.c.name, table.c.labels)
+        )
+    ]
+
+
+oaipmh_checkpoint_table = Table(
+    'oaipmh_checkpoint',
+    metadata,
+    Column('harvest_source_id', types.UnicodeText, primary_key=True),
+    Column('harvest_job_id', types.UnicodeText, nullable=False),
+    Column('verb', types.UnicodeText, nullable=False),
+    Column('args', types.UnicodeText),
+    Column('resumption_token', types.UnicodeText, nullable=False),
+    Column('objects_created', types.Integer, default=0),
+    Column('objects_queued', types.Boolean, default=False),
+    Column(
+        'updated',
+        types.DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    ),
+)
+
+oaipmh_partition_table = Table(
+    'oaipmh_partition',
+    metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+    Column('harvest_job_id', types.UnicodeText, nullable=False, index=True),
+    Column('args', types.UnicodeText, nullable=False),
+    Column('state', types.UnicodeText, nullable=False, default=u'NEW'),
+    Column('placeholder_id', types.UnicodeText),
+    Column('objects_created', types.Integer, default=0),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+    Column(
+        'updated',
+        types.DateTime,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow
+    ),
+)
+
+oaipmh_gathered_table = Table(
+    'oaipmh_gathered',
+    metadata,
+    Column('harvest_job_id', types.UnicodeText, primary_key=True),
+    Column('guid', types.UnicodeText, primary_key=True),
+    Column('harvest_source_id', types.UnicodeText, nullable=False,
+           index=True),
+)
+
+oaipmh_job_metric_table = Table(
+    'oaipmh_job_metric',
+    metadata,
+    Column('harvest_job_id', types.UnicodeText, primary_key=True),
+    Column('name', types.UnicodeText, primary_key=True),
+    Column('labels', types.UnicodeText, primary_key=True),
+    Column('observations', types.Integer, nullable=False, default=0),
+    Column('value', types.Float, nullable=False, default=0),
+)
+
+oaipmh_record_table = Table(
+    'oaipmh_record',
+    metadata,
+    Column('harvest_source_id', types.UnicodeText, primary_key=True),
+    Column('guid', types.UnicodeText, primary_key=True),
+    Column('metadata_prefix', types.UnicodeText, nullable=False),
+    Column('datestamp', types.DateTime),
+    Column('set_spec', types.UnicodeText),
+    Column('digest', types.UnicodeText, nullable=False),
+)
+
+oaipmh_replay_table = Table(
+    'oaipmh_replay',
+    metadata,
+    Column('harvest_job_id', types.UnicodeText, primary_key=True),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+)
+
+oaipmh_capability_table = Table(
+    'oaipmh_capability',
+    metadata,
+    Column('harvest_source_id', types.UnicodeText, primary_key=True),
+    Column('url', types.UnicodeText, nullable=False),
+    Column('capabilities', types.UnicodeText, nullable=False),
+    Column('probed', types.DateTime, nullable=False),
+)
+
+mapper(OaipmhCheckpoint, oaipmh_checkpoint_table)
+mapper(OaipmhPartition, oaipmh_partition_table)
+mapper(OaipmhRecord, oaipmh_record_table)
+mapper(OaipmhReplay, oaipmh_replay_table)
+mapper(OaipmhCapability, oaipmh_capability_table)
@@ -0,0 +1,176 @@
+'''
+Partitioned listing of a repository. A single resumption token chain has
+to be listed page after page, so the listing is split by sets or by date
+windows and the partitions are listed at the same time.
+'''
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from Queue import Empty, Queue
+
+from oaipmh import error
+from oaipmh.datestamp import datestamp_to_datetime
+from oaipmh.datestamp import datetime_to_datestamp
+
+from listing import list_pages
+
+log = logging.getLogger(__name__)
+
+# marks the end of the listing of a partition in the page queue
+_DONE = object()
+
+
+def set_partitions(client, set_spec=None):
+    '''
+    Return the listing arguments of the top-level sets of the repository,
+    or of the direct subsets of `set_spec` if one is given. Records which
+    are in none of these sets are not listed. Returns a single partition
+    without arguments if the repository has no sets.
+    '''
+    prefix = set_spec + ':' if set_spec else ''
+    try:
+        specs = [
+            spec for spec, _, _ in client.listSets()
+            if spec.startswith(prefix) and ':' not in spec[len(prefix):]
+        ]
+    except error.NoSetHierarchyError:
+        specs = []
+    if not specs:
+        log.info('No sets to partition the listing by')
+        return [{'set': set_spec}] if set_spec else [{}]
+    return [{'set': spec} for spec in specs]
+
+
+def date_partitions(start, count, day_granularity=False, end=None):
+    '''
+    Return the listing arguments of up to `count` date windows of the same
+    size from `start` to `end` (defaults to now). The last window has no
+    upper bound, so records changed during the listing are not left out.
+    As from and until are inclusive, each window ends one unit of the
+    granularity before the next one begins.
+    '''
+    end = end or datetime.utcnow()
+    if start is None or start >= end or count < 2:
+        return [{'from_': start}]
+    if day_granularity:
+        unit = timedelta(days=1)
+        start = datetime(start.year, start.month, start.day)
+        size = timedelta(days=((end - start) / count).days)
+    else:
+        unit = timedelta(seconds=1)
+        start = start.replace(microsecond=0)
+        size = timedelta(seconds=int(_seconds(end - start) / count))
+    size = max(size, unit)
+    bounds = []
+    while start < end and len(bounds) < count:
+        bounds.append(start)
+        start += size
+    partitions = []
+    for i, from_ in enumerate(bounds):
+        until = bounds[i + 1] - unit if i + 1 < len(bounds) else None
+        partitions.append({'from_': from_, 'until': until})
+    return partitions
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds
+
+
+def dump_partition(partition):
+    '''
+    Serialize the listing arguments of a partition as JSON.
+    '''
+    return json.dumps(dict(
+        (key, datetime_to_datestamp(value)
+         if isinstance(value, datetime) else value)
+        for key, value in partition.items()
+    ))
+
+
+def load_partition(data):
+    '''
+    Return the listing arguments of a partition serialized with
+    dump_partition.
+    '''
+    partition = json.loads(data)
+    for key in ('from_', 'until'):
+        if partition.get(key) is not None:
+            partition[key] = datestamp_to_datetime(partition[key])
+    return partition
+
+
+class PartitionedLister(object):
+    '''
+    Lists the partitions of a repository in up to `concurrency` threads.
+    The pages are handed to the calling thread, which does all database
+    work.
+    '''
+
+    def __init__(self, concurrency, queue_size=10):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+
+    def list_pages(self, client, verb, args, partitions):
+        '''
+        Yield the items of every listed page of all partitions, in no
+        particular order. `args` are the listing arguments shared by all
+        partitions. An exception raised while listing a partition stops
+        the listing and is raised again.
+        '''
+        pages = Queue(self.queue_size)
+        todo = Queue()
+        for partition in partitions:
+            todo.put(dict(args, **partition))
+        stop = threading.Event()
+        threads = [
+            threading.Thread(
+                target=self._list_partitions,
+                args=(client, verb, todo, pages, stop)
+            )
+            for _ in range(min(self.concurrency, len(partitions)))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                page = pages.get()
+                if page is _DONE:
+                    running -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            stop.set()
+            self._drain(pages, threads)
+
+    def _drain(self, pages, threads):
+        '''
+        Empty the page queue until all threads have ended, so that the
+        threads waiting for room in it are unblocked.
+        '''
+        while any(thread.is_alive() for thread in threads):
+            while not pages.empty():
+                pages.get()
+            for thread in threads:
+                thread.join(0.1)
+
+    def _list_partitions(self, client, verb, todo, pages, stop):
+        try:
+            while not stop.is_set():
+                try:
+                    args = todo.get_nowait()
+                except Empty:
+                    break
+                log.debug('List partition %s' % args)
+                for items, _ in list_pages(client, verb, args):
+                    if stop.is_set():
+                        break
+                    pages.put(items)
+        except Exception, e:
+            log.exception('Listing partition failed')
+            pages.put(e)
+        pages.put(_DONE)
@@ -0,0 +1,122 @@
+'''
+Pipelined fetching of records for a fetch consumer: while the consumer
+imports one object, a network thread requests the records of the next
+objects and a parse thread reads the responses, so that waiting for the
+repository, parsing and writing to the database overlap.
+'''
+import logging
+import threading
+from Queue import Queue
+
+log = logging.getLogger(__name__)
+
+# stops the threads of a pipeline
+_STOP = object()
+
+
+class RecordPipeline(object):
+    '''
+    Gets and parses the records of the identifiers put into it, in the
+    order they are put, with a network thread and a parse thread of its
+    own. Only the threads use the client. Every record is kept by the key
+    it has been put with, which defaults to its identifier, so that the
+    same identifier can be put under different keys. The caller limits
+    the number of records in the pipeline, see `outstanding`.
+    '''
+
+    def __init__(self, client, metadata_prefix):
+        self.client = client
+        self.metadata_prefix = metadata_prefix
+        self._requests = Queue()
+        self._responses = Queue()
+        # keys put, but not ready yet
+        self._pending = set()
+        # key: (record, exception) of the records ready
+        self._ready = {}
+        self._condition = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._request_records),
+            threading.Thread(target=self._parse_responses),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, identifier, key=None):
+        if key is None:
+            key = identifier
+        with self._condition:
+            self._pending.add(key)
+        self._requests.put((key, identifier))
+
+    def outstanding(self):
+        '''
+        Return the number of records put, but not taken yet.
+        '''
+        with self._condition:
+            return len(self._pending) + len(self._ready)
+
+    def __contains__(self, key):
+        with self._condition:
+            return key in self._pending or key in self._ready
+
+    def take(self, key=None):
+        '''
+        Return a (key, record, exception) tuple for each record which is
+        ready, either the record or the exception raised while getting it
+        is None. If `key` has been put, wait for its record first.
+        '''
+        with self._condition:
+            while key in self._pending:
+                self._condition.wait()
+            ready, self._ready = self._ready, {}
+        return [
+            (ready_key, record, e)
+            for ready_key, (record, e) in ready.iteritems()
+        ]
+
+    def close(self):
+        self._requests.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _request_records(self):
+        while True:
+            request = self._requests.get()
+            if request is _STOP:
+                self._responses.put(_STOP)
+                return
+            key, identifier = request
+            try:
+                xml = self.client.makeRequest(
+                    verb='GetRecord',
+                    identifier=identifier,
+                    metadataPrefix=self.metadata_prefix
+                )
+                self._responses.put((key, identifier, xml, None))
+            except Exception, e:
+                self._responses.put((key, identifier, None, e))
+
+    def _parse_responses(self):
+        while True:
+            item = self._responses.get()
+            if item is _STOP:
+                return
+            key, identifier, xml, e = item
+            record = None
+            if e is None:
+                try:
+                    record = self.client.handleResponse(
+                        'GetRecord',
+                        xml,
+                        identifier=identifier,
+                        metadataPrefix=self.metadata_prefix
+                    )
+                except Exception, parse_error:
+                    e = parse_error
+            if e is not None:
+                log.debug('getRecord failed for %s: %r' % (identifier, e))
+            with self._condition:
+                self._pending.discard(key)
+                self._ready[key] = (record, e)
+                self._condition.notify_all()
@@ -0,0 +1,106 @@
+'''
+Profiles of the stages of a harvest: the functions which take the most
+time, and the memory each stage allocates. Allocations are traced with
+tracemalloc if the interpreter has it, otherwise only the growth of the
+peak memory of the process is reported.
+'''
+import cProfile
+import pstats
+import resource
+import time
+from contextlib import contextmanager
+from StringIO import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class StageProfiler(object):
+    '''
+    Collects a profile, the time taken and the memory allocated per
+    stage over all calls profiled with `profile`.
+    '''
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self._profiles = {}
+        self._calls = {}
+        self._seconds = {}
+        self._peak_growth = {}
+        self._allocations = {}
+        self._stages = []
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def profile(self, stage):
+        if stage not in self._profiles:
+            self._profiles[stage] = cProfile.Profile()
+            self._stages.append(stage)
+        profile = self._profiles[stage]
+        snapshot = tracemalloc.take_snapshot() if self.trace_memory \
+            else None
+        peak = _peak_memory()
+        start = time.time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._add(self._seconds, stage, time.time() - start)
+            self._add(self._calls, stage, 1)
+            self._add(self._peak_growth, stage, _peak_memory() - peak)
+            if snapshot is not None:
+                self._add_allocations(stage, snapshot)
+
+    def report(self, limit=20, restrictions=()):
+        '''
+        Return the report of all stages as text, with the `limit`
+        functions with the highest cumulative time per stage. For each
+        of the `restrictions`, a regular expression, the functions of the
+        stages whose file name or name match it are listed as well.
+        '''
+        out = StringIO()
+        for stage in self._stages:
+            calls = self._calls[stage]
+            seconds = self._seconds[stage]
+            out.write(
+                '== %s: %s calls in %.2fs, %.1f ms per call, peak memory '
+                '+%s kB\n' % (
+                    stage, calls, seconds, seconds * 1000 / calls,
+                    self._peak_growth[stage]
+                )
+            )
+            stats = pstats.Stats(self._profiles[stage], stream=out)
+            stats.sort_stats('cumulative').print_stats(limit)
+            for restriction in restrictions:
+                stats.print_stats(restriction, limit)
+            allocations = self._allocations.get(stage)
+            if allocations:
+                out.write('Largest allocations:\n')
+                for line, size in sorted(
+                        allocations.items(),
+                        key=lambda item: -item[1])[:limit]:
+                    out.write('%10.1f kB  %s\n' % (size / 1024.0, line))
+                out.write('\n')
+        return out.getvalue()
+
+    def _add(self, values, stage, value):
+        values[stage] = values.get(stage, 0) + value
+
+    def _add_allocations(self, stage, before):
+        allocations = self._allocations.setdefault(stage, {})
+        after = tracemalloc.take_snapshot()
+        for diff in after.compare_to(before, 'lineno'):
+            if diff.size_diff > 0:
+                line = str(diff.traceback)
+                allocations[line] = allocations.get(line, 0) + diff.size_diff
+
+
+def _peak_memory():
+    '''
+    Return the peak memory of the process so far in kB.
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -0,0 +1,81 @@
+'''
+Recorded responses of a repository, so that a harvest can be repeated
+offline, e.g. to profile it.
+'''
+import errno
+import hashlib
+import os
+import zlib
+from urllib import urlencode
+
+import oaipmh.client
+
+from client import OaipmhClient
+
+
+class ResponseArchive(object):
+    '''
+    Stores the responses of a repository compressed in files below
+    `path`, named by the SHA-1 of the arguments of their request.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, kw, xml):
+        try:
+            os.makedirs(self.path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = self._path(kw)
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(xml))
+        os.rename(tmp_path, path)
+
+    def load(self, kw):
+        '''
+        Return the response to the request, raise KeyError if there is
+        none.
+        '''
+        try:
+            with open(self._path(kw), 'rb') as f:
+                return zlib.decompress(f.read())
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(kw)
+            raise
+
+    def _path(self, kw):
+        args = urlencode(sorted(
+            (key, unicode(value).encode('utf-8'))
+            for key, value in kw.items()
+        ))
+        return os.path.join(self.path, hashlib.sha1(args).hexdigest())
+
+
+class ArchivingClient(OaipmhClient):
+    '''
+    A client which saves every response it receives in `archive`, or
+    with `replay` answers every request from the archive instead of
+    asking the repository.
+    '''
+
+    def __init__(self, archive, replay, *args, **kw):
+        OaipmhClient.__init__(self, *args, **kw)
+        self.archive = archive
+        self.replay = replay
+
+    def makeRequest(self, **kw):
+        if getattr(self._responses, 'xml', None) is not None:
+            # a response handed to handleResponse
+            return OaipmhClient.makeRequest(self, **kw)
+        if self.replay:
+            try:
+                return self.archive.load(kw)
+            except KeyError:
+                raise oaipmh.client.Error('No recorded response for %s' % kw)
+        xml = OaipmhClient.makeRequest(self, **kw)
+        self.archive.save(kw, xml)
+        return xml
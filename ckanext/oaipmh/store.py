@@ -0,0 +1,54 @@
+'''
+A local content-addressed store for the raw XML of harvested records, so
+that they can be imported again without asking the repository.
+'''
+import errno
+import hashlib
+import os
+import zlib
+
+
+class RecordStore(object):
+    '''
+    Stores blobs compressed in files below `path`, named by the SHA-1 of
+    their data. Storing the same data twice stores it once. Blobs are
+    written to a temporary file first and then renamed, so that several
+    consumers can share the store.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def put(self, data):
+        '''
+        Store the data and return its digest.
+        '''
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._path(digest)
+        if os.path.exists(path):
+            return digest
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(data))
+        os.rename(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        '''
+        Return the data with the digest, raise KeyError if there is none.
+        '''
+        try:
+            with open(self._path(digest), 'rb') as f:
+                return zlib.decompress(f.read())
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(digest)
+            raise
+
+    def _path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
@@ -0,0 +1,398 @@
+'''
+Benchmarks of the OAI-PMH harvester against the synthetic repository in
+provider.py.
+
+The gather benchmark needs a CKAN database and the harvest and
+oaipmh_harvester plugins, e.g.:
+
+    python -m ckanext.oaipmh.tests.benchmark gather test.ini --records 100000
+
+The gather stage is run once per given batch size, a batch size of 1
+commits every HarvestObject on its own like the harvester used to.
+
+The harvest benchmark runs all stages of a job against the synthetic
+repository served over HTTP with the given latency per request, and
+reports the throughput and the median and 99th percentile latency of the
+list requests of the gather stage and of every fetched and imported
+object. It needs CKAN as well:
+
+    python -m ckanext.oaipmh.tests.benchmark harvest test.ini --latency 0.01
+
+The metadata benchmark needs no CKAN, it compares the records per second
+of the XPath based pyoai reader and the compiled reader:
+
+    python -m ckanext.oaipmh.tests.benchmark metadata --records 2000
+
+The transform benchmark compares the CPU time per record of splitting the
+content of records into tags and extras, before and after the transform
+of transform.py was introduced. It uses the munge functions of CKAN, but
+no database. With --profile, the profile of the transform is printed:
+
+    python -m ckanext.oaipmh.tests.benchmark transform --records 20000
+'''
+import argparse
+import cProfile
+import json
+import math
+import os
+import pstats
+import time
+
+from lxml import etree
+from oaipmh.metadata import MetadataReader
+
+from ckanext.oaipmh import metadata
+from ckanext.oaipmh.tests import provider
+
+NS_OAI = 'http://www.openarchives.org/OAI/2.0/'
+
+
+def load_environment(config_file):
+    from paste.deploy import appconfig
+    from ckan.config.environment import load_environment as load_ckan
+    conf = appconfig('config:' + os.path.abspath(config_file))
+    load_ckan(conf.global_conf, conf.local_conf)
+
+
+def create_harvester(server):
+    from ckanext.oaipmh.harvester import OaipmhHarvester
+
+    class BenchmarkHarvester(OaipmhHarvester):
+        def _create_client(self, url):
+            return provider.create_client(
+                server,
+                self._create_metadata_registry()
+            )
+
+    return BenchmarkHarvester()
+
+
+def create_job(name, config, url=provider.BASE_URL):
+    from ckan import model
+    from ckan.logic import get_action
+    from ckanext.harvest.model import HarvestJob
+
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {}
+        )['name'],
+        'ignore_auth': True,
+    }
+    source = get_action('harvest_source_create')(context.copy(), {
+        'title': name,
+        'name': name,
+        'url': url,
+        'source_type': 'oai_pmh',
+        'config': json.dumps(config),
+    })
+    job = get_action('harvest_job_create')(
+        context.copy(),
+        {'source_id': source['id']}
+    )
+    return HarvestJob.get(job['id'])
+
+
+def bench_gather(harvester, records, batch_size):
+    job = create_job(
+        'benchmark-gather-%s-%s' % (batch_size, int(time.time())),
+        {'gather_batch_size': batch_size}
+    )
+    start = time.time()
+    ids = harvester.gather_stage(job)
+    elapsed = time.time() - start
+    assert ids is not None and len(ids) == records, 'gather stage failed'
+    return elapsed
+
+
+def percentile(values, percent):
+    '''
+    Return the nearest-rank percentile of the values.
+    '''
+    values = sorted(values)
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def timed_requests(client, latencies):
+    '''
+    Record the duration of every request of the client in `latencies`.
+    '''
+    make_request = client.makeRequest
+
+    def timed(**kw):
+        start = time.time()
+        try:
+            return make_request(**kw)
+        finally:
+            latencies.append(time.time() - start)
+
+    client.makeRequest = timed
+
+
+def report(stage, count, elapsed, latencies, failed=0):
+    print(
+        '%-7s %8d in %7.2fs: %9.1f/s  p50 %8.2fms  p99 %8.2fms  %d failed'
+        % (stage, count, elapsed, count / elapsed,
+           percentile(latencies, 50) * 1000,
+           percentile(latencies, 99) * 1000,
+           failed)
+    )
+
+
+def timed_stage(stage, harvest_object_ids):
+    '''
+    Run a stage for every object, return the elapsed time, the latency of
+    every object and the number of objects the stage failed for.
+    '''
+    from ckanext.harvest.model import HarvestObject
+
+    latencies = []
+    failed = 0
+    start = time.time()
+    for harvest_object_id in harvest_object_ids:
+        harvest_object = HarvestObject.get(harvest_object_id)
+        object_start = time.time()
+        if not stage(harvest_object):
+            failed += 1
+        latencies.append(time.time() - object_start)
+    return time.time() - start, latencies, failed
+
+
+def run_harvest(args):
+    from ckanext.oaipmh.harvester import OaipmhHarvester
+
+    load_environment(args.config)
+    server = provider.HTTPProvider(
+        provider.create_server(
+            args.records,
+            args.page_size,
+            sets=args.sets,
+            deleted_every=args.deleted_every
+        ),
+        latency=args.latency,
+        compress=args.compress
+    ).start()
+    try:
+        harvester = OaipmhHarvester()
+        job = create_job(
+            'benchmark-harvest-%s' % int(time.time()),
+            json.loads(args.source_config),
+            url=server.url
+        )
+        harvester._set_config(job.source.config)
+        request_latencies = []
+        timed_requests(harvester._create_client(server.url), request_latencies)
+
+        start = time.time()
+        ids = harvester.gather_stage(job)
+        elapsed = time.time() - start
+        assert ids is not None, 'gather stage failed'
+        report('gather', len(ids), elapsed, request_latencies)
+
+        for stage in ('fetch', 'import'):
+            elapsed, latencies, failed = timed_stage(
+                getattr(harvester, stage + '_stage'), ids
+            )
+            report(stage, len(ids), elapsed, latencies, failed)
+    finally:
+        server.stop()
+
+
+def render_metadata(server, prefix, records):
+    '''
+    Return the metadata elements of the first `records` records of the
+    server, parsed like the client parses a response.
+    '''
+    elements = []
+    args = {'verb': 'ListRecords', 'metadataPrefix': prefix}
+    while len(elements) < records:
+        tree = etree.XML(server.handleRequest(args))
+        elements.extend(tree.iterfind(
+            './/{%s}record/{%s}metadata' % (NS_OAI, NS_OAI)
+        ))
+        token = tree.findtext('.//{%s}resumptionToken' % NS_OAI)
+        if not token:
+            break
+        args = {'verb': 'ListRecords', 'resumptionToken': token}
+    return elements[:records]
+
+
+def bench_metadata(reader, elements, repeat=3):
+    '''
+    Return the best time of `repeat` runs of reading all elements.
+    '''
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for element in elements:
+            reader(element)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_metadata(args):
+    server = provider.create_server(
+        args.records, args.page_size, args.variables
+    )
+    for prefix, compiled in [
+        ('oai_dc', metadata.oai_dc_reader),
+        ('oai_ddi', metadata.oai_ddi_reader),
+    ]:
+        elements = render_metadata(server, prefix, args.records)
+        readers = [
+            ('xpath', MetadataReader(compiled._fields, compiled._namespaces)),
+            ('compiled', compiled),
+        ]
+        for name, reader in readers:
+            elapsed = bench_metadata(reader, elements)
+            print(
+                'metadata %-7s %-8s %8d records in %7.2fs: %9.1f records/s'
+                % (prefix, name, len(elements), elapsed,
+                   len(elements) / elapsed)
+            )
+
+
+def legacy_tags_and_extras(content, mapped_fields, munge_tag):
+    '''
+    The loop of _extract_tags_and_extras before FieldTransform.
+    '''
+    from dateutil.parser import parse
+    extras = []
+    tags = []
+    for key, value in content.iteritems():
+        if key in list(mapped_fields):
+            continue
+        if key in ['type', 'subject']:
+            if type(value) is list:
+                tags.extend(value)
+            else:
+                tags.extend(value.split(';'))
+            continue
+        if value and type(value) is list:
+            value = value[0]
+        if not value:
+            value = None
+        if key.endswith('date') and value:
+            try:
+                value = parse(value).replace(tzinfo=None).isoformat()
+            except (ValueError, TypeError):
+                continue
+        extras.append((key, value))
+    return [munge_tag(tag[:100]) for tag in tags], extras
+
+
+def run_transform(args):
+    from ckan.lib.munge import munge_tag
+    from ckanext.oaipmh.harvester import OaipmhHarvester, _munge_tag
+    from ckanext.oaipmh.transform import FieldTransform
+
+    server = provider.create_server(args.records, args.page_size)
+    contents = []
+    for element in render_metadata(server, 'oai_dc', args.records):
+        content = metadata.oai_dc_reader(element).getMap()
+        content['set_spec'] = []
+        contents.append(content)
+    mapped_fields = OaipmhHarvester()._get_mapping().values()
+    transform = FieldTransform(mapped_fields, _munge_tag)
+    runs = [
+        ('before', lambda content: legacy_tags_and_extras(
+            content, mapped_fields, munge_tag
+        )),
+        ('after', transform.tags_and_extras),
+    ]
+    for name, func in runs:
+        best = None
+        for _ in xrange(3):
+            start = time.clock()
+            for content in contents:
+                func(content)
+            elapsed = time.clock() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(
+            'transform %-6s %8d records in %7.2fs: %7.1f us/record'
+            % (name, len(contents), best, best * 1e6 / len(contents))
+        )
+    if args.profile:
+        profile = cProfile.Profile()
+        profile.enable()
+        for content in contents:
+            transform.tags_and_extras(content)
+        profile.disable()
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(15)
+
+
+def run_gather(args):
+    load_environment(args.config)
+    server = provider.create_server(args.records, args.page_size)
+    harvester = create_harvester(server)
+    for batch_size in [int(s) for s in args.batch_sizes.split(',')]:
+        elapsed = bench_gather(harvester, args.records, batch_size)
+        print(
+            'gather batch_size=%-6s %8d objects in %7.2fs: %9.1f objects/s'
+            % (batch_size, args.records, elapsed, args.records / elapsed)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers()
+
+    gather = subparsers.add_parser('gather', help='gather stage, needs CKAN')
+    gather.add_argument('config', help='CKAN configuration file')
+    gather.add_argument('--records', type=int, default=100000)
+    gather.add_argument('--page-size', type=int, default=100)
+    gather.add_argument(
+        '--batch-sizes', default='1,500',
+        help='comma separated gather batch sizes to compare'
+    )
+    gather.set_defaults(run=run_gather)
+
+    harvest = subparsers.add_parser('harvest', help='all stages, needs CKAN')
+    harvest.add_argument('config', help='CKAN configuration file')
+    harvest.add_argument('--records', type=int, default=1000)
+    harvest.add_argument('--page-size', type=int, default=100)
+    harvest.add_argument('--sets', type=int, default=0)
+    harvest.add_argument('--deleted-every', type=int, default=0)
+    harvest.add_argument(
+        '--latency', type=float, default=0,
+        help='seconds the repository takes to answer a request'
+    )
+    harvest.add_argument(
+        '--compress', action='store_true',
+        help='gzip the responses of the repository'
+    )
+    harvest.add_argument(
+        '--source-config', default='{}',
+        help='configuration of the harvest source as JSON'
+    )
+    harvest.set_defaults(run=run_harvest)
+
+    reader = subparsers.add_parser('metadata', help='metadata readers')
+    reader.add_argument('--records', type=int, default=2000)
+    reader.add_argument('--page-size', type=int, default=100)
+    reader.add_argument(
+        '--variables', type=int, default=50,
+        help='number of variables in the data description of DDI records'
+    )
+    reader.set_defaults(run=run_metadata)
+
+    transform = subparsers.add_parser(
+        'transform', help='tags and extras, needs CKAN but no database'
+    )
+    transform.add_argument('--records', type=int, default=20000)
+    transform.add_argument('--page-size', type=int, default=100)
+    transform.add_argument(
+        '--profile', action='store_true',
+        help='print the profile of the transform'
+    )
+    transform.set_defaults(run=run_transform)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
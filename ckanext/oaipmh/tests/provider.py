@@ -0,0 +1,357 @@
+'''
+A synthetic OAI-PMH repository which can stand in for a remote provider
+in tests and benchmarks.
+'''
+import math
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+from gzip import GzipFile
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+from lxml.etree import SubElement
+from oaipmh import common, error
+from oaipmh.client import ServerClient
+from oaipmh.metadata import MetadataRegistry
+from oaipmh.server import BatchingServer, oai_dc_writer
+
+from ckanext.oaipmh.metadata import oai_dc_reader
+
+BASE_URL = 'http://localhost/oai'
+EARLIEST_DATESTAMP = datetime(2010, 1, 1)
+
+NS_DDI = 'http://www.icpsr.umich.edu/DDI'
+NS_XML = 'http://www.w3.org/XML/1998/namespace'
+NO_NAMESPACE = {None: ''}
+
+METADATA_FORMATS = [
+    (
+        'oai_dc',
+        'http://www.openarchives.org/OAI/2.0/oai_dc.xsd',
+        'http://www.openarchives.org/OAI/2.0/oai_dc/',
+    ),
+    (
+        'oai_ddi',
+        'http://www.icpsr.umich.edu/DDI/Version2-0.xsd',
+        NS_DDI,
+    ),
+]
+
+
+class SyntheticRepository(object):
+    '''
+    Generates `size` oai_dc or oai_ddi records on the fly. Record number
+    i has the identifier oai:synthetic:i and is stamped i minutes after
+    the earliest datestamp. With `sets`, record i is in the set
+    'set<i % sets>'. With `deleted_every`, every record whose number is a
+    multiple of it is deleted. It implements the batching interface of
+    pyoai, so wrap it in an oaipmh.server.BatchingServer to serve it.
+    '''
+
+    def __init__(self, size, sets=0, deleted_every=0):
+        self.size = size
+        self.sets = sets
+        self.deleted_every = deleted_every
+
+    def identify(self):
+        return common.Identify(
+            repositoryName='Synthetic repository',
+            baseURL=BASE_URL,
+            protocolVersion='2.0',
+            adminEmails=['admin@localhost'],
+            earliestDatestamp=EARLIEST_DATESTAMP,
+            deletedRecord='persistent' if self.deleted_every else 'no',
+            granularity='YYYY-MM-DDThh:mm:ssZ',
+            compression=['identity'],
+        )
+
+    def listMetadataFormats(self, identifier=None):
+        return METADATA_FORMATS
+
+    def listSets(self, cursor=0, batch_size=10):
+        if not self.sets:
+            raise error.NoSetHierarchyError('This repository has no sets.')
+        return [
+            ('set%d' % index, 'Set %d' % index, None)
+            for index in xrange(cursor, min(cursor + batch_size, self.sets))
+        ]
+
+    def listIdentifiers(self, metadataPrefix, set=None, from_=None,
+                        until=None, cursor=0, batch_size=10):
+        self._check_prefix(metadataPrefix)
+        return [
+            self._header(index)
+            for index in self._indices(set, from_, until, cursor, batch_size)
+        ]
+
+    def listRecords(self, metadataPrefix, set=None, from_=None,
+                    until=None, cursor=0, batch_size=10):
+        self._check_prefix(metadataPrefix)
+        return [
+            self._record(index)
+            for index in self._indices(set, from_, until, cursor, batch_size)
+        ]
+
+    def getRecord(self, metadataPrefix, identifier):
+        self._check_prefix(metadataPrefix)
+        try:
+            index = int(identifier.rsplit(':', 1)[1])
+        except (IndexError, ValueError):
+            raise error.IdDoesNotExistError(identifier)
+        if not 0 <= index < self.size:
+            raise error.IdDoesNotExistError(identifier)
+        return self._record(index)
+
+    def _check_prefix(self, metadata_prefix):
+        if metadata_prefix not in [f[0] for f in METADATA_FORMATS]:
+            raise error.CannotDisseminateFormatError(metadata_prefix)
+
+    def _indices(self, set, from_, until, cursor, batch_size):
+        '''
+        Return the numbers of a batch of the records which match the
+        arguments of a list request.
+        '''
+        first, last = 0, self.size
+        if from_ is not None:
+            first = max(first, int(math.ceil(_minutes(from_))))
+        if until is not None:
+            last = min(last, int(math.floor(_minutes(until))) + 1)
+        step = 1
+        if set is not None:
+            if not self.sets or not set.startswith('set'):
+                return []
+            try:
+                offset = int(set[len('set'):])
+            except ValueError:
+                return []
+            # the first record in the set at or after the first record
+            first += (offset - first) % self.sets
+            step = self.sets
+        start = first + cursor * step
+        stop = min(last, first + (cursor + batch_size) * step)
+        return xrange(start, max(start, stop), step)
+
+    def _header(self, index):
+        return common.Header(
+            None,
+            'oai:synthetic:%d' % index,
+            EARLIEST_DATESTAMP + timedelta(minutes=index),
+            ['set%d' % (index % self.sets)] if self.sets else [],
+            self._is_deleted(index)
+        )
+
+    def _is_deleted(self, index):
+        return bool(self.deleted_every) and index % self.deleted_every == 0
+
+    def _record(self, index):
+        if self._is_deleted(index):
+            return self._header(index), None, None
+        metadata = common.Metadata(None, {
+            'title': [u'Synthetic record %d' % index],
+            'creator': [u'Doe, Jane', u'Roe, Richard'],
+            'subject': [u'synthetic', u'record %d' % (index % 10)],
+            'description': [u'Record number %d of a test repository.' % index],
+            'publisher': [u'Synthetic Publisher'],
+            'contributor': [],
+            'date': [u'2014-01-%02d' % (index % 28 + 1)],
+            'type': [u'Dataset'],
+            'format': [u'text/csv'],
+            'identifier': [u'http://localhost/records/%d' % index],
+            'source': [],
+            'language': [u'en'],
+            'relation': [],
+            'coverage': [],
+            'rights': [u'CC-BY'],
+        })
+        return self._header(index), metadata, None
+
+
+def _minutes(datestamp):
+    '''
+    Return the minutes from the earliest datestamp to the given one.
+    '''
+    delta = datestamp - EARLIEST_DATESTAMP
+    return (delta.days * 86400 + delta.seconds) / 60.0
+
+
+class DdiWriter(object):
+    '''
+    Writes the fields of a record as DDI codeBook, at the paths read by
+    ckanext.oaipmh.metadata.oai_ddi_reader, which expects the elements
+    below codeBook in no namespace. The data description of the codeBook
+    lists `variables` variables.
+    '''
+
+    def __init__(self, variables=0):
+        self.variables = variables
+
+    def __call__(self, element, metadata):
+        map = metadata.getMap()
+        e_codebook = SubElement(element, '{%s}codeBook' % NS_DDI,
+                                nsmap={'ddi': NS_DDI})
+        e_codebook.set('{%s}lang' % NS_XML, map['language'][0])
+        # the OAI-PMH default namespace of the enclosing elements has to be
+        # undeclared, or the children of codeBook would be read in it
+        e_study = SubElement(e_codebook, 'stdyDscr', nsmap=NO_NAMESPACE)
+        e_citation = SubElement(e_study, 'citation')
+        self._add(e_citation, 'titlStmt/titl', map['title'])
+        self._add(e_citation, 'titlStmt/IDNo', map['identifier'])
+        self._add(e_citation, 'rspStmt/AuthEnty', map['creator'])
+        self._add(e_citation, 'distStmt/contact', map['publisher'])
+        self._add(e_citation, 'prodStmt/prodDate', map['date'])
+        e_info = SubElement(e_study, 'stdyInfo')
+        self._add(e_info, 'subject/keyword', map['subject'])
+        self._add(e_info, 'abstract', map['description'])
+        self._add(e_info, 'sumDscr/dataKind', map['type'])
+        e_place = SubElement(
+            SubElement(SubElement(e_study, 'dataAccs'), 'setAvail'),
+            'accsPlac'
+        )
+        e_place.set('URI', map['identifier'][0])
+        for file_type in map['format']:
+            e_file = SubElement(e_codebook, 'fileDscr', nsmap=NO_NAMESPACE)
+            self._add(e_file, 'fileType', [file_type])
+        e_data = SubElement(e_codebook, 'dataDscr', nsmap=NO_NAMESPACE)
+        for index in xrange(self.variables):
+            e_var = SubElement(e_data, 'var', name='v%d' % index)
+            SubElement(e_var, 'labl').text = u'Variable %d' % index
+            for value in xrange(5):
+                e_category = SubElement(e_var, 'catgry')
+                SubElement(e_category, 'catValu').text = unicode(value)
+                SubElement(e_category, 'labl').text = u'Category %d' % value
+
+    def _add(self, element, path, values):
+        '''
+        Add an element at the path below `element` for each value, the
+        parent elements of the path are shared.
+        '''
+        steps = path.split('/')
+        for step in steps[:-1]:
+            child = element.find(step)
+            if child is None:
+                child = SubElement(element, step)
+            element = child
+        for value in values:
+            SubElement(element, steps[-1]).text = value
+
+
+def create_server(size, batch_size=100, variables=0, sets=0,
+                  deleted_every=0):
+    '''
+    Return a pyoai server for a synthetic repository of `size` records
+    with `batch_size` records per resumption page. DDI records describe
+    `variables` variables each. See SyntheticRepository for `sets` and
+    `deleted_every`.
+    '''
+    registry = MetadataRegistry()
+    registry.registerWriter('oai_dc', oai_dc_writer)
+    registry.registerWriter('oai_ddi', DdiWriter(variables))
+    return BatchingServer(
+        SyntheticRepository(size, sets, deleted_every),
+        metadata_registry=registry,
+        resumption_batch_size=batch_size
+    )
+
+
+def create_client(server, metadata_registry):
+    '''
+    Return an OAI-PMH client which talks to `server` in-process.
+    '''
+    return ServerClient(server, metadata_registry)
+
+
+def create_registry():
+    '''
+    Return a metadata registry which reads oai_dc records with the reader
+    of the harvester.
+    '''
+    registry = MetadataRegistry()
+    registry.registerReader('oai_dc', oai_dc_reader)
+    return registry
+
+
+def create_synthetic_client(size, **kw):
+    '''
+    Return an in-process client of a synthetic repository of `size`
+    records with 10 records per page, see create_server for `kw`.
+    '''
+    return create_client(create_server(size, 10, **kw), create_registry())
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self._respond(urlparse.urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self._respond(self.rfile.read(length))
+
+    def _respond(self, query):
+        args = dict(
+            (key, values[0])
+            for key, values in urlparse.parse_qs(query).items()
+        )
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        try:
+            body = self.server.oai_server.handleRequest(args)
+        except Exception:
+            self.send_error(500)
+            return
+        accepted = self.headers.getheader('Accept-Encoding') or ''
+        compress = self.server.compress and 'gzip' in accepted
+        if compress:
+            body = _gzip(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _gzip(data):
+    buf = StringIO()
+    f = GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+class HTTPProvider(ThreadingMixIn, HTTPServer):
+    '''
+    Serves a pyoai server over HTTP on localhost in a background thread,
+    so that the harvester can be pointed at `url` like at a remote
+    repository. Every request is answered after `latency` seconds. With
+    `compress`, the responses are gzip compressed for clients which
+    accept it.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, oai_server, latency=0, port=0, compress=False):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _RequestHandler)
+        self.oai_server = oai_server
+        self.latency = latency
+        self.compress = compress
+        self.url = 'http://127.0.0.1:%d/oai' % self.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
@@ -0,0 +1,27 @@
+from ckanext.oaipmh.cache import LRUCache
+from ckanext.oaipmh.cache import memoize
+
+
+class TestLRUCache(object):
+
+    def test_drops_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert len(cache) == 2
+        assert cache.get('b') is None
+        assert cache.get('a') == 1 and cache.get('c') == 3
+
+    def test_memoize(self):
+        calls = []
+
+        def double(value):
+            calls.append(value)
+            return value * 2
+
+        memoized = memoize(double, 2)
+        assert [memoized(v) for v in [1, 2, 1, 3, 2]] == [2, 4, 2, 6, 4]
+        assert calls == [1, 2, 3, 2]
+        assert len(memoized.cache) == 2
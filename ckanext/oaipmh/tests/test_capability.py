@@ -0,0 +1,75 @@
+from datetime import datetime
+
+from ckanext.oaipmh.capability import Capabilities
+from ckanext.oaipmh.capability import PARTITION_SECONDS
+from ckanext.oaipmh.listing import list_pages
+from ckanext.oaipmh.tests import provider
+
+
+class TestCapabilities(object):
+
+    def test_probe(self):
+        capabilities = Capabilities.probe(
+            provider.create_synthetic_client(20, sets=3, deleted_every=5)
+        )
+        assert capabilities.granularity == 'YYYY-MM-DDThh:mm:ssZ'
+        assert not capabilities.day_granularity
+        assert capabilities.deleted_record == 'persistent'
+        assert capabilities.earliest_datestamp == provider.EARLIEST_DATESTAMP
+        assert capabilities.metadata_prefixes == ['oai_dc', 'oai_ddi']
+        assert capabilities.sets == ['set0', 'set1', 'set2']
+        assert capabilities.pages == {} and capabilities.records is None
+
+    def test_probe_without_sets(self):
+        client = provider.create_synthetic_client(20)
+        assert Capabilities.probe(client).sets == []
+
+    def test_dump_and_load(self):
+        client = provider.create_synthetic_client(20, sets=3)
+        capabilities = Capabilities.probe(client)
+        capabilities.observe_page('ListRecords', 100, 0.5)
+        capabilities.records = 1000
+        loaded = Capabilities.load(capabilities.dump())
+        assert loaded.__dict__ == capabilities.__dict__
+
+    def test_measures_list_pages(self):
+        capabilities = Capabilities()
+        pages = list(list_pages(
+            provider.create_synthetic_client(25),
+            'ListIdentifiers',
+            {'metadataPrefix': 'oai_dc'},
+            observe=capabilities.observe_page
+        ))
+        assert len(pages) == 3
+        page = capabilities.pages['ListIdentifiers']
+        # the averages move towards the last, smaller page
+        assert 5 < page['items'] < 10
+        assert page['seconds'] > 0
+
+    def test_strategy(self):
+        capabilities = Capabilities(
+            earliest_datestamp=datetime(2010, 1, 1),
+            metadata_prefixes=['oai_dc'],
+            sets=['a', 'b'],
+        )
+        assert capabilities.strategy('oai_dc') == {
+            'list_records': True, 'partition': None
+        }
+        capabilities.observe_page('ListIdentifiers', 100, 1.0)
+        capabilities.records = 100 * (PARTITION_SECONDS + 1)
+        assert capabilities.strategy('oai_dc')['partition'] == 'dates'
+        assert capabilities.strategy('oai_dc', full=False)['partition'] is None
+        capabilities.earliest_datestamp = None
+        # partitioning by sets would leave out records in no set
+        assert capabilities.strategy('oai_dc')['partition'] is None
+        capabilities.records = 100
+        assert capabilities.strategy('oai_dc')['partition'] is None
+
+    def test_strategy_unknown_format(self):
+        capabilities = Capabilities(metadata_prefixes=['oai_dc'])
+        try:
+            capabilities.strategy('oai_ddi')
+        except ValueError:
+            pass
+        else:
+            assert False, 'oai_ddi offered'
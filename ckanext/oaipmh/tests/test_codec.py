@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import json
+
+from ckanext.oaipmh.codec import decode_content
+from ckanext.oaipmh.codec import encode_content
+
+CONTENT = json.dumps({
+    'title': [u'Z\xfcrich'],
+    'description': [u'A long description. ' * 50],
+})
+
+
+class TestCodec(object):
+
+    def test_plain(self):
+        assert encode_content(CONTENT) == CONTENT
+        assert decode_content(CONTENT) == CONTENT
+        assert decode_content(None) is None
+
+    def test_compressed(self):
+        encoded = encode_content(CONTENT, compress=True)
+        assert encoded.startswith(u'z1:')
+        assert len(encoded) * 5 < len(CONTENT)
+        assert json.loads(decode_content(encoded)) == json.loads(CONTENT)
+
+    def test_unicode_content(self):
+        content = json.dumps({'title': [u'Z\xfcrich']}, ensure_ascii=False)
+        encoded = encode_content(content, compress=True)
+        assert decode_content(encoded) == content
@@ -0,0 +1,41 @@
+from ckanext.oaipmh.gathered import GatheredObjects
+from ckanext.oaipmh.gathered import StreamedObjects
+
+
+class Publisher(object):
+
+    def __init__(self):
+        self.messages = []
+        self.closed = False
+
+    def send(self, message):
+        self.messages.append(message)
+
+    def close(self):
+        self.closed = True
+
+
+class TestGatheredObjects(object):
+
+    def test_returned(self):
+        gathered = GatheredObjects()
+        gathered.extend(['a', 'b'])
+        gathered.committed()
+        gathered.extend(['c'])
+        assert len(gathered) == 3
+        assert gathered.result() == ['a', 'b', 'c']
+
+    def test_streamed(self):
+        publisher = Publisher()
+        gathered = StreamedObjects(publisher)
+        gathered.extend(['a', 'b'])
+        assert publisher.messages == []
+        gathered.committed()
+        gathered.extend(['c'])
+        gathered.committed()
+        gathered.close()
+        assert [m['harvest_object_id'] for m in publisher.messages] == \
+            ['a', 'b', 'c']
+        assert len(gathered) == 3
+        assert gathered.result() == []
+        assert publisher.closed
@@ -0,0 +1,173 @@
+from lxml import etree
+from oaipmh.metadata import MetadataReader
+
+from ckanext.oaipmh.metadata import CompiledMetadataReader
+from ckanext.oaipmh.metadata import PruningParser
+from ckanext.oaipmh.metadata import ddi_parser
+from ckanext.oaipmh.metadata import oai_dc_reader
+from ckanext.oaipmh.metadata import oai_ddi_reader
+
+OAI_DC_RECORD = '''
+<metadata xmlns="http://www.openarchives.org/OAI/2.0/">
+  <oai_dc:dc
+      xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+      xmlns:dc="http://purl.org/dc/elements/1.1/"
+      xmlns:oai="http://www.openarchives.org/OAI/2.0/">
+    <dc:title>Swiss Household Panel</dc:title>
+    <dc:creator>Doe, Jane</dc:creator>
+    <dc:creator>Roe, <!-- comment -->Richard</dc:creator>
+    <dc:subject>households</dc:subject>
+    <dc:subject/>
+    <dc:description>Mixed <b>content</b> with a tail</dc:description>
+    <dc:date>2014-05-01</dc:date>
+    <dc:identifier>http://example.org/1</dc:identifier>
+    <dc:identifier>urn:example:1</dc:identifier>
+    <dc:language>de</dc:language>
+    <dc:rights><![CDATA[CC <BY>]]></dc:rights>
+    <oai:maintainer_email>jane@example.org</oai:maintainer_email>
+    <title>no namespace, no match</title>
+  </oai_dc:dc>
+  <oai_dc:dc
+      xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/"
+      xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>Second dc element</dc:title>
+  </oai_dc:dc>
+</metadata>
+'''
+
+OAI_DDI_RECORD = '''
+<metadata xmlns="http://www.openarchives.org/OAI/2.0/">
+  <codeBook xmlns="http://www.icpsr.umich.edu/DDI" xml:lang="en">
+    <stdyDscr xmlns="">
+      <citation>
+        <titlStmt>
+          <titl>Social Survey</titl>
+          <IDNo>SS-2014</IDNo>
+        </titlStmt>
+        <rspStmt><AuthEnty>Institute</AuthEnty></rspStmt>
+        <prodStmt><prodDate>2014</prodDate></prodStmt>
+        <serStmt><serName>Surveys</serName></serStmt>
+      </citation>
+      <stdyInfo>
+        <subject><keyword>work</keyword><keyword>income</keyword></subject>
+        <abstract>An abstract</abstract>
+        <sumDscr>
+          <timePrd>2014</timePrd>
+          <geogCover>Switzerland</geogCover>
+          <dataKind>survey</dataKind>
+        </sumDscr>
+      </stdyInfo>
+      <dataAccs><setAvail><accsPlac URI="http://example.org/ss"/></setAvail></dataAccs>
+    </stdyDscr>
+    <fileDscr xmlns=""><fileType>SPSS</fileType></fileDscr>
+    <fileDscr xmlns=""><fileType>CSV</fileType></fileDscr>
+    <dataDscr xmlns=""><var name="v1"><labl>Variable 1</labl></var></dataDscr>
+  </codeBook>
+</metadata>
+'''
+
+
+RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+  <GetRecord>
+    <record>
+      <header><identifier>oai:example:1</identifier></header>
+      %s
+    </record>
+  </GetRecord>
+</OAI-PMH>
+'''
+
+NS = {
+    'oai': 'http://www.openarchives.org/OAI/2.0/',
+    'ddi': 'http://www.icpsr.umich.edu/DDI',
+}
+
+
+def _read(reader, record):
+    return reader(etree.XML(record)).getMap()
+
+
+def _plain_reader(reader):
+    return MetadataReader(reader._fields, reader._namespaces)
+
+
+class TestCompiledMetadataReader(object):
+
+    def test_oai_dc_same_as_xpath(self):
+        expected = _read(_plain_reader(oai_dc_reader), OAI_DC_RECORD)
+        assert _read(oai_dc_reader, OAI_DC_RECORD) == expected
+        assert expected['title'] == [
+            u'Swiss Household Panel', u'Second dc element'
+        ]
+        assert expected['creator'] == [u'Doe, Jane', u'Roe, ', u'Richard']
+
+    def test_oai_ddi_same_as_xpath(self):
+        expected = _read(_plain_reader(oai_ddi_reader), OAI_DDI_RECORD)
+        assert _read(oai_ddi_reader, OAI_DDI_RECORD) == expected
+        assert expected['language'] == [u'en']
+        assert expected['source'] == [u'http://example.org/ss']
+        assert expected['format'] == [u'SPSS', u'CSV']
+
+    def test_empty_record(self):
+        record = '<metadata xmlns="http://www.openarchives.org/OAI/2.0/"/>'
+        expected = _read(_plain_reader(oai_dc_reader), record)
+        assert _read(oai_dc_reader, record) == expected
+        assert all(value == [] for value in expected.values())
+
+    def test_other_expressions_use_xpath(self):
+        fields = {
+            'title': ('text', 'string(oai_dc:dc/dc:title)'),
+            'dates': ('textList', 'oai_dc:dc/dc:date[1]/text()'),
+            'creators': ('textList', '//dc:creator/text()'),
+            'subjects': ('bytesList', 'oai_dc:dc/dc:subject/text()'),
+        }
+        namespaces = oai_dc_reader._namespaces
+        reader = CompiledMetadataReader(fields, namespaces)
+        assert sorted(reader._xpath_fields) == sorted(fields)
+        expected = _read(MetadataReader(fields, namespaces), OAI_DC_RECORD)
+        assert _read(reader, OAI_DC_RECORD) == expected
+
+
+class TestPruningParser(object):
+
+    def _metadata(self, tree):
+        return tree.find('.//{%s}metadata' % NS['oai'])
+
+    def test_same_as_unpruned(self):
+        response = RESPONSE % OAI_DDI_RECORD.replace(
+            '<titl>Social Survey</titl>',
+            '<titl>Social <emph>mixed</emph> Survey</titl>'
+        )
+        expected = oai_ddi_reader(self._metadata(etree.XML(response)))
+        tree = ddi_parser(response)
+        metadata = oai_ddi_reader(self._metadata(tree))
+        assert metadata.getMap() == expected.getMap()
+        assert metadata.getField('title') == [u'Social ', u' Survey']
+        assert tree.findtext('.//{%s}identifier' % NS['oai']) == \
+            'oai:example:1'
+
+    def test_drops_data_description(self):
+        variables = ''.join(
+            '<var name="v%d"><labl>Variable %d</labl></var>' % (i, i)
+            for i in range(1000)
+        )
+        response = RESPONSE % OAI_DDI_RECORD.replace(
+            '<var name="v1"><labl>Variable 1</labl></var>', variables
+        )
+        tree = ddi_parser(response)
+        assert tree.xpath('//ddi:codeBook', namespaces=NS)
+        assert not tree.xpath('//dataDscr | //var')
+        assert len(tree.xpath('//fileDscr/fileType')) == 2
+
+    def test_other_metadata_is_kept(self):
+        response = RESPONSE % OAI_DC_RECORD
+        tree = ddi_parser(response)
+        assert etree.tostring(tree) == etree.tostring(etree.XML(response))
+
+    def test_xpath_reader_is_not_pruned(self):
+        fields = {'title': ('text', 'string(oai_ddi:codeBook)')}
+        reader = CompiledMetadataReader(fields, oai_ddi_reader._namespaces)
+        response = RESPONSE % OAI_DDI_RECORD
+        tree = PruningParser(reader)(response)
+        assert tree.xpath('//dataDscr/var')
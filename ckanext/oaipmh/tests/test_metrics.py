@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+
+from ckanext.oaipmh.metrics import Metrics
+from ckanext.oaipmh.metrics import format_labels
+
+
+class TestMetrics(object):
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.count('response_bytes', 100, verb='GetRecord')
+        metrics.count('response_bytes', 50, verb='GetRecord')
+        metrics.count('unchanged')
+        metrics.observe('request', 0.5, verb='GetRecord', status=None)
+        metrics.observe('request', 1.5, verb='GetRecord')
+        assert metrics.prometheus().splitlines() == [
+            'oaipmh_response_bytes_total{verb="GetRecord"} 150',
+            'oaipmh_unchanged_total 1',
+            'oaipmh_request_seconds_count{verb="GetRecord"} 2',
+            'oaipmh_request_seconds_sum{verb="GetRecord"} 2.0',
+        ]
+
+    def test_timer(self):
+        metrics = Metrics()
+        try:
+            with metrics.timer('parse', stage='fetch'):
+                raise ValueError()
+        except ValueError:
+            pass
+        assert 'oaipmh_parse_seconds_count{stage="fetch"} 1\n' in \
+            metrics.prometheus()
+
+    def test_job_values(self):
+        metrics = Metrics()
+        metrics.count('objects')
+        assert metrics._job_values == {}
+        metrics._job_id = 'job'
+        metrics.count('objects', 2, stage='import')
+        metrics.observe('stage', 0.25, stage='import')
+        metrics.observe('stage', 0.25, stage='import')
+        assert metrics._job_values == {
+            ('objects', (('stage', 'import'),)): (0, 2),
+            ('stage_seconds', (('stage', 'import'),)): (2, 0.5),
+        }
+        assert format_labels((('stage', 'import'), ('verb', 'x'))) == \
+            'stage=import,verb=x'
+
+    def test_write(self):
+        metrics = Metrics()
+        metrics.count('objects', stage='gather')
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'oaipmh.prom')
+            metrics.write(path)
+            with open(path) as f:
+                assert f.read() == 'oaipmh_objects_total{stage="gather"} 1\n'
+            assert os.listdir(directory) == ['oaipmh.prom']
+        finally:
+            shutil.rmtree(directory)
+
+    def test_flush_writes_file_of_process(self):
+        metrics = Metrics()
+        metrics.count('objects', stage='fetch')
+        directory = tempfile.mkdtemp()
+        try:
+            metrics.path = os.path.join(directory, 'oaipmh.prom')
+            metrics.flush()
+            assert os.listdir(directory) == []
+            metrics.flush(force=True)
+            name = 'oaipmh.%s.prom' % os.getpid()
+            assert os.listdir(directory) == [name]
+            with open(os.path.join(directory, name)) as f:
+                assert f.read() == (
+                    'oaipmh_objects_total{stage="fetch",pid="%s"} 1\n'
+                    % os.getpid()
+                )
+        finally:
+            shutil.rmtree(directory)
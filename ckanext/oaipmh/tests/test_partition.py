@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+
+from ckanext.oaipmh.partition import PartitionedLister
+from ckanext.oaipmh.partition import date_partitions
+from ckanext.oaipmh.partition import dump_partition
+from ckanext.oaipmh.partition import load_partition
+from ckanext.oaipmh.partition import set_partitions
+from ckanext.oaipmh.tests import provider
+
+
+class TestDatePartitions(object):
+
+    def test_windows_cover_range(self):
+        partitions = date_partitions(
+            datetime(2014, 1, 1, 0, 0, 0, 500),
+            4,
+            end=datetime(2014, 1, 1, 0, 1, 40)
+        )
+        assert partitions == [
+            {'from_': datetime(2014, 1, 1, 0, 0, 0),
+             'until': datetime(2014, 1, 1, 0, 0, 24)},
+            {'from_': datetime(2014, 1, 1, 0, 0, 25),
+             'until': datetime(2014, 1, 1, 0, 0, 49)},
+            {'from_': datetime(2014, 1, 1, 0, 0, 50),
+             'until': datetime(2014, 1, 1, 0, 1, 14)},
+            {'from_': datetime(2014, 1, 1, 0, 1, 15), 'until': None},
+        ]
+
+    def test_day_granularity(self):
+        partitions = date_partitions(
+            datetime(2014, 1, 1, 12),
+            2,
+            day_granularity=True,
+            end=datetime(2014, 1, 11)
+        )
+        assert partitions == [
+            {'from_': datetime(2014, 1, 1), 'until': datetime(2014, 1, 5)},
+            {'from_': datetime(2014, 1, 6), 'until': None},
+        ]
+
+    def test_short_range(self):
+        partitions = date_partitions(
+            datetime(2014, 1, 1),
+            10,
+            day_granularity=True,
+            end=datetime(2014, 1, 3)
+        )
+        assert [p['from_'].day for p in partitions] == [1, 2]
+        assert partitions[-1]['until'] is None
+
+    def test_single_window(self):
+        assert date_partitions(None, 4) == [{'from_': None}]
+        assert date_partitions(datetime(2014, 1, 1), 1) == [
+            {'from_': datetime(2014, 1, 1)}
+        ]
+
+    def test_dump_and_load(self):
+        partitions = date_partitions(
+            datetime(2014, 1, 1), 2, end=datetime(2014, 1, 3)
+        )
+        partitions.append({'set': 'a:b'})
+        for partition in partitions:
+            assert load_partition(dump_partition(partition)) == partition
+
+
+class TestSetPartitions(object):
+
+    def test_no_sets(self):
+        client = provider.create_synthetic_client(10)
+        assert set_partitions(client) == [{}]
+        assert set_partitions(client, 'a') == [{'set': 'a'}]
+
+    def test_top_level_sets(self):
+        client = provider.create_synthetic_client(10, sets=3)
+        assert set_partitions(client) == [
+            {'set': 'set0'}, {'set': 'set1'}, {'set': 'set2'}
+        ]
+
+
+class TestPartitionedLister(object):
+
+    def test_lists_date_windows(self):
+        client = provider.create_synthetic_client(100)
+        partitions = date_partitions(
+            provider.EARLIEST_DATESTAMP,
+            4,
+            end=provider.EARLIEST_DATESTAMP + timedelta(minutes=100)
+        )
+        pages = PartitionedLister(4).list_pages(
+            client,
+            'ListIdentifiers',
+            {'metadataPrefix': 'oai_dc'},
+            partitions
+        )
+        identifiers = [h.identifier() for page in pages for h in page]
+        assert sorted(identifiers) == sorted(
+            'oai:synthetic:%d' % index for index in range(100)
+        )
+
+    def test_lists_all_partitions(self):
+        client = provider.create_synthetic_client(25)
+        lister = PartitionedLister(2)
+        pages = list(lister.list_pages(
+            client,
+            'ListIdentifiers',
+            {'metadataPrefix': 'oai_dc'},
+            [{}, {}, {}]
+        ))
+        # every partition lists the whole repository
+        assert len(pages) == 9
+        identifiers = [h.identifier() for page in pages for h in page]
+        assert len(identifiers) == 75
+        assert len(set(identifiers)) == 25
+
+    def test_error_stops_listing(self):
+        client = provider.create_synthetic_client(25)
+        lister = PartitionedLister(2)
+        pages = lister.list_pages(
+            client,
+            'ListIdentifiers',
+            {'metadataPrefix': 'unknown'},
+            [{}, {}]
+        )
+        try:
+            list(pages)
+        except Exception, e:
+            assert 'unknown' in str(e)
+        else:
+            assert False, 'listing did not fail'
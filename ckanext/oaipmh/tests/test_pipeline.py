@@ -0,0 +1,70 @@
+from oaipmh import error
+
+from ckanext.oaipmh.client import OaipmhClient
+from ckanext.oaipmh.pipeline import RecordPipeline
+from ckanext.oaipmh.tests import provider
+
+
+class TestRecordPipeline(object):
+
+    @classmethod
+    def setup_class(cls):
+        cls.provider = provider.HTTPProvider(
+            provider.create_server(20), latency=0.01
+        ).start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.provider.stop()
+
+    def setup(self):
+        client = OaipmhClient(self.provider.url, provider.create_registry())
+        self.pipeline = RecordPipeline(client, 'oai_dc')
+
+    def teardown(self):
+        self.pipeline.close()
+
+    def test_records(self):
+        identifiers = ['oai:synthetic:%d' % index for index in range(5)]
+        for identifier in identifiers:
+            self.pipeline.put(identifier)
+        assert self.pipeline.outstanding() == 5
+        ready = dict(
+            (key, record) for key, record, e in
+            self.pipeline.take(identifiers[-1])
+        )
+        # the records are got in the order they have been put
+        assert sorted(ready) == sorted(identifiers)
+        header, metadata, _ = ready['oai:synthetic:3']
+        assert header.identifier() == 'oai:synthetic:3'
+        assert metadata.getField('title') == [u'Synthetic record 3']
+        assert self.pipeline.outstanding() == 0
+        assert self.pipeline.take() == []
+
+    def test_errors_are_returned(self):
+        self.pipeline.put('oai:synthetic:100')
+        self.pipeline.put('oai:synthetic:1')
+        ready = dict(
+            (key, (record, e)) for key, record, e in
+            self.pipeline.take('oai:synthetic:100')
+        )
+        record, e = ready['oai:synthetic:100']
+        assert record is None
+        assert isinstance(e, error.IdDoesNotExistError)
+        ready = self.pipeline.take('oai:synthetic:1') + ready.items()
+        assert 'oai:synthetic:1' in [item[0] for item in ready]
+
+    def test_same_identifier_under_different_keys(self):
+        self.pipeline.put('oai:synthetic:2', 'first')
+        self.pipeline.put('oai:synthetic:2', 'second')
+        assert 'first' in self.pipeline
+        ready = dict(
+            (key, record) for key, record, e in self.pipeline.take('first')
+        )
+        if 'second' not in ready:
+            ready.update(
+                (key, record) for key, record, e in
+                self.pipeline.take('second')
+            )
+        assert sorted(ready) == ['first', 'second']
+        assert ready['second'][0].identifier() == 'oai:synthetic:2'
@@ -0,0 +1,21 @@
+from ckanext.oaipmh.profiling import StageProfiler
+
+
+def _work(size):
+    return sorted(range(size), reverse=True)
+
+
+class TestStageProfiler(object):
+
+    def test_report(self):
+        profiler = StageProfiler()
+        for _ in range(3):
+            with profiler.profile('fetch'):
+                _work(1000)
+        with profiler.profile('import'):
+            _work(10)
+        report = profiler.report(restrictions=['test_profiling'])
+        assert '== fetch: 3 calls' in report
+        assert '== import: 1 calls' in report
+        assert report.index('== fetch') < report.index('== import')
+        assert '_work' in report
@@ -0,0 +1,119 @@
+from datetime import datetime
+
+import requests
+from oaipmh import error
+
+from ckanext.oaipmh.client import OaipmhClient
+from ckanext.oaipmh.metrics import metrics
+from ckanext.oaipmh.tests import provider
+
+
+def _identifiers(headers):
+    return [int(h.identifier().rsplit(':', 1)[1]) for h in headers]
+
+
+class TestSyntheticRepository(object):
+
+    def test_sets(self):
+        client = provider.create_synthetic_client(20, sets=3)
+        headers = list(client.listIdentifiers(
+            metadataPrefix='oai_dc', set='set2'
+        ))
+        assert _identifiers(headers) == [2, 5, 8, 11, 14, 17]
+        assert headers[0].setSpec() == ['set2']
+
+    def test_from_until(self):
+        client = provider.create_synthetic_client(100)
+        headers = client.listIdentifiers(
+            metadataPrefix='oai_dc',
+            from_=datetime(2010, 1, 1, 0, 10, 30),
+            until=datetime(2010, 1, 1, 0, 40)
+        )
+        assert _identifiers(headers) == range(11, 41)
+
+    def test_no_records_match(self):
+        client = provider.create_synthetic_client(10)
+        try:
+            list(client.listIdentifiers(
+                metadataPrefix='oai_dc', from_=datetime(2020, 1, 1)
+            ))
+        except error.NoRecordsMatchError:
+            pass
+        else:
+            assert False, 'records matched'
+
+    def test_deleted_records(self):
+        client = provider.create_synthetic_client(20, deleted_every=5)
+        assert client.identify().deletedRecord() == 'persistent'
+        records = list(client.listRecords(metadataPrefix='oai_dc'))
+        deleted = [h for h, metadata, _ in records if h.isDeleted()]
+        assert _identifiers(deleted) == [0, 5, 10, 15]
+        assert records[0][1] is None
+        assert records[1][1].getField('title') == [u'Synthetic record 1']
+
+
+class TestHTTPProvider(object):
+
+    def test_serves_over_http(self):
+        server = provider.HTTPProvider(
+            provider.create_server(25, 10), latency=0.01
+        ).start()
+        try:
+            for force_http_get in (False, True):
+                client = OaipmhClient(
+                    server.url,
+                    provider.create_registry(),
+                    force_http_get=force_http_get
+                )
+                headers = client.listIdentifiers(metadataPrefix='oai_dc')
+                assert _identifiers(headers) == range(25)
+                client.close()
+        finally:
+            server.stop()
+
+    def test_request_timeout(self):
+        server = provider.HTTPProvider(
+            provider.create_server(25, 10), latency=0.5
+        ).start()
+        try:
+            client = OaipmhClient(
+                server.url, provider.create_registry(), timeout=0.1
+            )
+            try:
+                client.identify()
+            except requests.exceptions.Timeout:
+                pass
+            else:
+                assert False, 'request did not time out'
+            client.close()
+        finally:
+            server.stop()
+
+    def test_compressed_responses(self):
+        server = provider.HTTPProvider(
+            provider.create_server(25, 10), compress=True
+        ).start()
+        # the counters are shared by all tests of the process
+        before = _list_records_bytes()
+        try:
+            client = OaipmhClient(server.url, provider.create_registry())
+            records = list(client.listRecords(metadataPrefix='oai_dc'))
+            assert len(records) == 25
+            client.close()
+        finally:
+            server.stop()
+        after = _list_records_bytes()
+        transferred = after['transferred_bytes'] - before['transferred_bytes']
+        received = after['response_bytes'] - before['response_bytes']
+        assert 0 < transferred * 3 < received
+
+
+def _list_records_bytes():
+    values = dict(
+        (name, value) for (name, labels), value
+        in metrics._counters.items() if labels == (('verb', 'ListRecords'),)
+    )
+    return dict(
+        (name, values.get(name, 0))
+        for name in ('transferred_bytes', 'response_bytes')
+    )
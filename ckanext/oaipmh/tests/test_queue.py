@@ -1,12 +1,15 @@
 import os
+import shutil
+import tempfile
 from ckanext.oaipmh.harvester import OaipmhHarvester
+import ckanext.oaipmh.model as oaipmh_model
 import ckanext.harvest.model as harvest_model
 from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
 import ckanext.harvest.queue as queue
 import json
 import ckan.logic as logic
 from ckan import model
-from pprint import pprint
+from ckanext.oaipmh.tests import provider
 
 
 class TestOaipmhHarvester(OaipmhHarvester):
@@ -25,9 +28,14 @@ class TestHarvestQueue(object):
     @classmethod
     def setup_class(cls):
         harvest_model.setup()
+        oaipmh_model.setup()
+        cls.provider = provider.HTTPProvider(
+            provider.create_server(25, batch_size=10)
+        ).start()
 
     @classmethod
     def teardown_class(cls):
+        cls.provider.stop()
         model.repo.rebuild_db()
 
     def test_01_basic_harvester(self):
@@ -49,7 +57,7 @@ class TestHarvestQueue(object):
         source_dict = {
             'title': 'Test Source',
             'name': 'test-source',
-            'url': 'http://www.lidata.eu/oaiprovider/',
+            'url': self.provider.url,
             'source_type': 'test',
         }
 
@@ -83,7 +91,132 @@ class TestHarvestQueue(object):
 
         queue.gather_callback(consumer, *reply)
 
-        # reply = consumer_fetch.basic_get(queue='ckan.harvest.fetch')
-        # queue.fetch_callback(consumer_fetch, *reply)
+        all_objects = model.Session.query(HarvestObject).filter(
+            HarvestObject.harvest_job_id == job_id
+        ).all()
+        assert len(all_objects) == 25
+        assert set(obj.guid for obj in all_objects) == set(
+            'oai:synthetic:%d' % index for index in range(25)
+        )
+
+        reply = consumer_fetch.basic_get(queue='ckan.harvest.fetch')
+        queue.fetch_callback(consumer_fetch, *reply)
+        harvest_object_id = json.loads(reply[2])['harvest_object_id']
+        assert HarvestObject.get(harvest_object_id).state == u'COMPLETE'
+
+
+class TestDeletedRecords(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+        oaipmh_model.setup()
+        cls.provider = provider.HTTPProvider(
+            provider.create_server(25, batch_size=10, deleted_every=5)
+        ).start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.provider.stop()
+        model.repo.rebuild_db()
+
+    def test_deleted_records_are_not_gathered(self):
+        user = logic.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {}
+        )['name']
+        context = {'model': model, 'session': model.Session,
+                   'user': user, 'api_version': 3, 'ignore_auth': True}
+        harvest_source = logic.get_action('harvest_source_create')(
+            context,
+            {
+                'title': 'Deleting Source',
+                'name': 'deleting-source',
+                'url': self.provider.url,
+                'source_type': 'test',
+            }
+        )
+        harvest_job = harvest_model.HarvestJob.get(
+            logic.get_action('harvest_job_create')(
+                context,
+                {'source_id': harvest_source['id']}
+            )['id']
+        )
+
+        harvest_obj_ids = TestOaipmhHarvester().gather_stage(harvest_job)
+
+        guids = set(
+            HarvestObject.get(obj_id).guid for obj_id in harvest_obj_ids
+        )
+        assert guids == set(
+            'oai:synthetic:%d' % index for index in range(25)
+            if index % 5
+        )
+
+
+class RemappedHarvester(OaipmhHarvester):
+
+    def _get_mapping(self):
+        return dict(OaipmhHarvester._get_mapping(self), notes='subject')
+
+
+class TestReplay(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+        oaipmh_model.setup()
+        cls.provider = provider.HTTPProvider(
+            provider.create_server(5, batch_size=10)
+        ).start()
+        cls.store_path = tempfile.mkdtemp()
+        if model.User.by_name(u'harvest') is None:
+            model.User(name=u'harvest', sysadmin=True).save()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.provider.stop()
+        shutil.rmtree(cls.store_path)
+        model.repo.rebuild_db()
+
+    def _run_job(self, harvester, context, source_id):
+        harvester.configure({'ckanext.oaipmh.record_store': self.store_path})
+        harvest_job = harvest_model.HarvestJob.get(
+            logic.get_action('harvest_job_create')(
+                context,
+                {'source_id': source_id}
+            )['id']
+        )
+        for harvest_obj_id in harvester.gather_stage(harvest_job):
+            harvest_object = HarvestObject.get(harvest_obj_id)
+            assert harvester.fetch_stage(harvest_object)
+            assert harvester.import_stage(harvest_object)
+            harvest_object.state = u'COMPLETE'
+            harvest_object.save()
+        harvest_job.status = u'Finished'
+        harvest_job.save()
+
+    def test_replay_applies_changed_mapping(self):
+        user = logic.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {}
+        )['name']
+        context = {'model': model, 'session': model.Session,
+                   'user': user, 'api_version': 3, 'ignore_auth': True}
+        harvest_source = logic.get_action('harvest_source_create')(
+            context,
+            {
+                'title': 'Replayed Source',
+                'name': 'replayed-source',
+                'url': self.provider.url,
+                'source_type': 'test',
+                'config': json.dumps({'store_records': True}),
+            }
+        )
+
+        self._run_job(OaipmhHarvester(), context, harvest_source['id'])
+        assert model.Package.get('oai-synthetic-1').notes == \
+            u'Record number 1 of a test repository.'
 
-        assert 1 == 2
+        source = harvest_model.HarvestSource.get(harvest_source['id'])
+        source.config = json.dumps({'store_records': True, 'replay': True})
+        source.save()
+        self._run_job(RemappedHarvester(), context, harvest_source['id'])
+        model.Session.expire_all()
+        assert model.Package.get('oai-synthetic-1').notes == u'synthetic'
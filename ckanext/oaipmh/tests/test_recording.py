@@ -0,0 +1,42 @@
+import shutil
+import tempfile
+
+import oaipmh.client
+
+from ckanext.oaipmh.recording import ArchivingClient
+from ckanext.oaipmh.recording import ResponseArchive
+from ckanext.oaipmh.tests import provider
+
+
+class TestArchivingClient(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test_replay_offline(self):
+        archive = ResponseArchive(self.path)
+        registry = provider.create_registry()
+        server = provider.HTTPProvider(provider.create_server(25, 10))
+        url = server.start().url
+        try:
+            client = ArchivingClient(archive, False, url, registry)
+            recorded = list(client.listRecords(metadataPrefix='oai_dc'))
+        finally:
+            server.stop()
+
+        client = ArchivingClient(archive, True, url, registry)
+        replayed = list(client.listRecords(metadataPrefix='oai_dc'))
+        assert [h.identifier() for h, _, _ in replayed] == \
+            [h.identifier() for h, _, _ in recorded]
+        assert replayed[3][1].getMap() == recorded[3][1].getMap()
+
+        try:
+            client.getRecord(identifier='oai:synthetic:1',
+                             metadataPrefix='oai_dc')
+        except oaipmh.client.Error:
+            pass
+        else:
+            assert False, 'not recorded'
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+
+from lxml import etree
+from oaipmh.metadata import MetadataRegistry
+
+from ckanext.oaipmh.metadata import oai_ddi_reader
+from ckanext.oaipmh.store import RecordStore
+from ckanext.oaipmh.tests import provider
+
+
+class TestRecordStore(object):
+
+    def setup(self):
+        self.path = tempfile.mkdtemp()
+        self.store = RecordStore(self.path)
+
+    def teardown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_and_get(self):
+        digest = self.store.put('<metadata/>')
+        assert digest == self.store.put('<metadata/>')
+        assert self.store.get(digest) == '<metadata/>'
+        assert self.store.put('<other/>') != digest
+        files = [
+            name for _, _, names in os.walk(self.path) for name in names
+        ]
+        assert len(files) == 2
+
+    def test_missing(self):
+        try:
+            self.store.get('0' * 40)
+        except KeyError:
+            pass
+        else:
+            assert False, 'no KeyError'
+
+    def test_replayed_metadata_is_read_the_same(self):
+        registry = MetadataRegistry()
+        registry.registerReader('oai_ddi', oai_ddi_reader)
+        client = provider.create_client(
+            provider.create_server(10, variables=3), registry
+        )
+        _, metadata, _ = client.getRecord(
+            identifier='oai:synthetic:4', metadataPrefix='oai_ddi'
+        )
+        digest = self.store.put(
+            etree.tostring(metadata.element(), encoding='UTF-8')
+        )
+        element = etree.XML(self.store.get(digest))
+        replayed = registry.readMetadata('oai_ddi', element)
+        assert replayed.getMap() == metadata.getMap()
+        assert replayed.getField('title') == [u'Synthetic record 4']
@@ -0,0 +1,97 @@
+from dateutil.parser import parse
+
+from ckanext.oaipmh.transform import FieldTransform
+from ckanext.oaipmh.transform import normalize_date
+
+DATES = [
+    u'2014-05-01',
+    u'2014-05-01T10:30',
+    u'2014-05-01T10:30:15',
+    u'2014-05-01 10:30:15',
+    u'2014-05-01T10:30:15Z',
+    u'2014-05-01T10:30:15.5Z',
+    u'2014-05-01T10:30:15.1234567',
+    u'2014-05-01T10:30:15+02:00',
+    u'2014-05-01T23:59:59-0530',
+    u'2014-05-01T00:00:00+01',
+    u'1999-12-31',
+    u'2012-02-29',
+    u'1 May 2014',
+    u'May 2014, 10:30',
+    u'2014/05/01',
+    u' 2014-05-01 ',
+]
+
+NO_DATES = [u'2014-02-30', u'2014-13-01', u'no date', u'2014-05-01T25:00']
+
+
+def _legacy_normalize(value):
+    return parse(value).replace(tzinfo=None).isoformat()
+
+
+def _legacy_tags_and_extras(content, mapped_fields, munge_tag):
+    extras = []
+    tags = []
+    for key, value in content.iteritems():
+        if key in mapped_fields:
+            continue
+        if key in ['type', 'subject']:
+            if type(value) is list:
+                tags.extend(value)
+            else:
+                tags.extend(value.split(';'))
+            continue
+        if value and type(value) is list:
+            value = value[0]
+        if not value:
+            value = None
+        if key.endswith('date') and value:
+            try:
+                value = _legacy_normalize(value)
+            except (ValueError, TypeError):
+                continue
+        extras.append((key, value))
+    return [munge_tag(tag[:100]) for tag in tags], extras
+
+
+class TestNormalizeDate(object):
+
+    def test_same_as_dateutil(self):
+        for value in DATES:
+            assert normalize_date(value) == _legacy_normalize(value), value
+
+    def test_no_date(self):
+        for value in NO_DATES:
+            try:
+                normalize_date(value)
+            except ValueError:
+                pass
+            else:
+                assert False, value
+
+
+class TestFieldTransform(object):
+
+    def test_same_as_before(self):
+        content = {
+            'title': [u'Title'],
+            'description': [u'Mapped, not an extra'],
+            'subject': [u'households', u'x' * 150],
+            'type': u'Dataset;Survey',
+            'date': [u'2014-05-01T10:30:15+02:00'],
+            'issued_date': [u'2014-02-30'],
+            'modified_date': u'1 May 2014',
+            'language': [u'de', u'en'],
+            'rights': [],
+            'set_spec': [],
+        }
+        mapped_fields = ['title', 'description']
+        transform = FieldTransform(mapped_fields, unicode.upper)
+        tags, extras = transform.tags_and_extras(content)
+        assert (tags, extras) == _legacy_tags_and_extras(
+            content, mapped_fields, unicode.upper
+        )
+        assert len(tags) == 4 and max(len(tag) for tag in tags) == 100
+        assert (u'date', '2014-05-01T10:30:15') in extras
+        assert (u'rights', None) in extras
+        assert 'issued_date' not in dict(extras)
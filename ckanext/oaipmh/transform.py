@@ -0,0 +1,96 @@
+'''
+The conversion of the content of a record to the tags and extras of its
+dataset, which runs for every imported record. It is built once for the
+field mapping of a source, and dates in ISO 8601 format, which is what
+repositories mostly send, are read without dateutil.
+'''
+import re
+from datetime import datetime
+
+from dateutil.parser import parse
+
+# fields whose values become tags
+TAG_FIELDS = ('type', 'subject')
+# tags are cut to this length before they are munged
+MAX_TAG_LENGTH = 100
+
+# a date, or a date and time with optional seconds, fraction and offset
+_ISO_DATETIME = re.compile(
+    r'([1-9]\d{3})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d+))?)?'
+    r'(?:Z|[+-]\d\d(?::?\d\d)?)?)?$'
+)
+
+
+def normalize_date(value):
+    '''
+    Return the date or time as ISO 8601 without the time zone, the local
+    time is kept as it is. Raises ValueError or TypeError if the value is
+    no date. The result is the same as the one of dateutil, which is only
+    used for values which are not in ISO 8601 format.
+    '''
+    match = _ISO_DATETIME.match(value) if isinstance(value, basestring) \
+        else None
+    if match is not None:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        try:
+            return datetime(
+                int(year), int(month), int(day),
+                int(hour or 0), int(minute or 0), int(second or 0),
+                # like dateutil, only microseconds are kept
+                int(fraction.ljust(6, '0')[:6]) if fraction else 0
+            ).isoformat()
+        except ValueError:
+            pass
+    # the ckan indexer can't handle timezone-aware datetime objects
+    return parse(value).replace(tzinfo=None).isoformat()
+
+
+class FieldTransform(object):
+    '''
+    Splits the content of a record into tags and extras. The fields in
+    `mapped_fields` are left out, as they are mapped to fields of the
+    dataset. Tags are munged with `munge_tag`.
+    '''
+
+    def __init__(self, mapped_fields, munge_tag):
+        self.mapped_fields = frozenset(mapped_fields)
+        self.munge_tag = munge_tag
+
+    def tags_and_extras(self, content):
+        '''
+        Return the munged tags and the (key, value) extras of the content.
+        Extras whose key ends with 'date' are left out unless their value
+        is a date.
+        '''
+        extras = []
+        tags = []
+        for key, value in content.iteritems():
+            if key in self.mapped_fields:
+                continue
+            if key in TAG_FIELDS:
+                if type(value) is list:
+                    tags.extend(value)
+                else:
+                    tags.extend(value.split(';'))
+                continue
+            try:
+                extras.append((key, self._extra_value(key, value)))
+            except (ValueError, TypeError):
+                continue
+        munge_tag = self.munge_tag
+        return [munge_tag(tag[:MAX_TAG_LENGTH]) for tag in tags], extras
+
+    def _extra_value(self, key, value):
+        '''
+        Return the first value of an extra, or None if it has none. Raises
+        ValueError or TypeError if the key ends with 'date' and the value
+        is not a date.
+        '''
+        if value and type(value) is list:
+            value = value[0]
+        if not value:
+            return None
+        if key.endswith('date'):
+            return normalize_date(value)
+        return value
@@ -25,5 +25,8 @@ setup(
     """
     [ckan.plugins]
     oaipmh_harvester=ckanext.oaipmh.harvester:OaipmhHarvester
+
+    [paste.paster_command]
+    oaipmh=ckanext.oaipmh.commands:OaipmhCommand
     """,
 )